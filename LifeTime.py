@@ -20,8 +20,12 @@
 import wx, wx.richtext
 import os, time, subprocess, re, threading, sys, traceback
 import stanford
+import instrument
 import serial
 from LifetimeImager import *
+from datacube import SeriesCube
+from darks import DarkLibrary
+from flatfield import FlatFieldLibrary
 
 
 # begin wxGlade: extracode
@@ -69,6 +73,14 @@ class LifeTimeFrame(wx.Frame):
         self.text_ctrl_Messages.EndSymbolBullet()
         self.text_ctrl_Messages.Newline()
 
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('# comment: ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Lines starting with # and empty lines are skipped. Any other line that is not command(parameters) stops the script before it starts.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
         self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
         self.text_ctrl_Messages.BeginBold()
         self.text_ctrl_Messages.AppendText('exptime(1.5): ')
@@ -125,6 +137,94 @@ class LifeTimeFrame(wx.Frame):
         self.text_ctrl_Messages.EndSymbolBullet()
         self.text_ctrl_Messages.Newline()
 
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('cube(1): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Save following series in one data cube bg.cube.npy with index bg.index.npy instead of one file per delay. cube(0) switches back.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('readback(1): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Read the ICCD status back while each following image is taken and warn if its delay differs. Off by default, readback(0) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('raw(1): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Also record every single raw frame of following measurements, e.g. to bg.raw.npy. raw(0) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('encoding(uint32): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Image file format: scaled (uint16 .mat, default), uint32 (.mat), mat-zlib (compressed uint32 .mat) or npz (compressed uint32 .npz)')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('variance(1): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Also save the per-pixel variance and SNR maps (\'variance\', \'snr\') in the image file. variance(0) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('stack(clip): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('How frames are combined: sum (default), clip (3 sigma clipped mean, stack(clip,2.5) sets the threshold) or median (approximate median). Saved as the mean times the number of frames.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('snr(50), maxframes(2000), snrroi(300,200,40,40): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Stop averaging once the median over the region x=300, y=200, 40x40 pixels (whole image if not set) of the per-pixel SNR reaches 50, checked every 10 frames, but take at most 2000 frames (frames() if not set). snr(0) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('dark(0,3600): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Subtract a background taken at 0 ns delay with the same settings from the following images. Backgrounds are kept in the \'darks\' directory and retaken when older than 3600 s. dark(off) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('flat(c:\\flats): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Divide the following images by the flat field for the MCP voltage, from flat_<mcp>V.npy or .mat files in the directory. Voltages in between are interpolated. flat(off) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('roi(300,200,64,64): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Only sum and save the region x=300, y=200, 64x64 pixels of every frame. roi(off) keeps the whole frame.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
+        self.text_ctrl_Messages.BeginSymbolBullet('*',20,30)
+        self.text_ctrl_Messages.BeginBold()
+        self.text_ctrl_Messages.AppendText('bin(2): ')
+        self.text_ctrl_Messages.EndBold()
+        self.text_ctrl_Messages.AppendText('Sum 2x2 pixel blocks of every frame (after the roi) before averaging. bin(1) switches it off.')
+        self.text_ctrl_Messages.EndSymbolBullet()
+        self.text_ctrl_Messages.Newline()
+
         self.text_ctrl_Messages.BeginBold()
         self.text_ctrl_Messages.AppendText('#### SCRIPT OUTPUT ####')
         self.text_ctrl_Messages.EndBold()
@@ -220,6 +320,12 @@ class LifeTimeFrame(wx.Frame):
             self.isRunning = True
         
     def runScript(self): 
+        for linenumber in range(self.text_ctrl_MeasurementList.GetNumberOfLines()):
+            text=self.text_ctrl_MeasurementList.GetLineText(linenumber)
+            if text.strip() and not text.strip().startswith('#') and self.__parseLine(text) is None:
+                self.__error('Line %d is not command(parameters):\n%s' % (linenumber+1, text))
+                return -1
+
         dlg = wx.DirDialog(self, "Choose data output directory", 
                            defaultPath = os.getcwd(), 
                            style = wx.DD_CHANGE_DIR)
@@ -235,41 +341,112 @@ class LifeTimeFrame(wx.Frame):
         self.threshold=None
         self.frames=None
         self.mcp=None
+        self.cube=False
+        self.readback=False
+        self.snr=None
+        self.maxframes=None
+        self.snrroi=None
+        self.darkDelay=None
+        self.darkLibrary=DarkLibrary(os.getcwd() + '/darks')
+        self.flatLibrary=None
 
         self.parent.setupCamera(wx.EVT_BUTTON)
 
-        for linenumber in range(self.text_ctrl_MeasurementList.GetNumberOfLines()):
-            text=self.text_ctrl_MeasurementList.GetLineText(linenumber)
-            if re.match('^(\w+)\(([\w\,\.\-_]+)\)$',text):
-                [command,parameters]=text.rstrip(')').split('(')
-                parameters=parameters.split(',')
-                res = 0
-                if command == 'subdir':
-                    res=self.commandSubdir(parameters)
-                elif command == 'exptime':
-                    self.exptime = float(parameters[0])
-                elif command == 'mcp':
-                    self.mcp = int(parameters[0])
-                elif command == 'frames':
-                    self.frames = int(parameters[0])
-                elif command == 'threshold':
-                    self.threshold = int(parameters[0])
-                elif command == 'serial':
-                    res=self.sendSerial(parameters)
-                elif command == 'single':
-                    res=self.commandSingle(parameters)
-                elif command == 'series':
-                    res=self.commandSeries(parameters)
-                else:
-                    self.__error('%s: unknown command' % command)
-                    return -1
-
-                if res != 0:
-                    return -1
+        # keep the camera live for the whole script, capture() only starts new accumulations
+        try:
+            imager = self.lifetimeImagerFactory.getCamera()
+            imager.openSession()
+        except Exception, e:
+            self.__error('LifetimeImager returned an error!\n%s\nThe most likely cause is a background pythonw.exe process using the camera.' % e)
+            return -1
 
-                if self.stopFlag.isSet():
-                    self.__debug('abort flag was set in runScript, aborting ...')
-                    return -1
+        try:
+            imager.startOutputWriter()
+            imager.setRecordRaw(False).setEncoding('scaled').setTrackVariance(False).setStackMode('sum').setDark(None).setFlatField(None)\
+                .setRoi(None).setBinning(1)
+            for linenumber in range(self.text_ctrl_MeasurementList.GetNumberOfLines()):
+                text=self.text_ctrl_MeasurementList.GetLineText(linenumber)
+                parsed=self.__parseLine(text)
+                if parsed is not None:
+                    [command,parameters]=parsed
+                    res = 0
+                    if command == 'subdir':
+                        res=self.commandSubdir(parameters)
+                    elif command == 'exptime':
+                        self.exptime = float(parameters[0])
+                    elif command == 'mcp':
+                        self.mcp = int(parameters[0])
+                    elif command == 'frames':
+                        self.frames = int(parameters[0])
+                    elif command == 'threshold':
+                        self.threshold = int(parameters[0])
+                    elif command == 'cube':
+                        self.cube = int(parameters[0]) != 0
+                    elif command == 'readback':
+                        self.readback = int(parameters[0]) != 0
+                    elif command == 'raw':
+                        imager.setRecordRaw(int(parameters[0]) != 0)
+                    elif command == 'variance':
+                        imager.setTrackVariance(int(parameters[0]) != 0)
+                    elif command == 'snr':
+                        self.snr = float(parameters[0])
+                    elif command == 'maxframes':
+                        self.maxframes = int(parameters[0])
+                    elif command == 'snrroi':
+                        self.snrroi = tuple([int(p) for p in parameters[0:4]])
+                    elif command == 'dark':
+                        if parameters[0] == 'off':
+                            self.darkDelay = None
+                        else:
+                            self.darkDelay = float(parameters[0])*1000 # in ps
+                            if len(parameters) > 1:
+                                self.darkLibrary.maxAge = float(parameters[1])
+                    elif command == 'flat':
+                        if parameters[0] == 'off':
+                            self.flatLibrary = None
+                        else:
+                            self.flatLibrary = FlatFieldLibrary(parameters[0])
+                            if len(self.flatLibrary.voltages()) == 0:
+                                self.__error('No flat_<mcp>V files in %s' % parameters[0])
+                                return -1
+                    elif command == 'roi':
+                        if parameters[0] == 'off':
+                            imager.setRoi(None)
+                        else:
+                            imager.setRoi([int(p) for p in parameters[0:4]])
+                    elif command == 'bin':
+                        imager.setBinning(int(parameters[0]))
+                    elif command == 'stack':
+                        if parameters[0] not in FrameAccumulator.MODES:
+                            self.__error('%s: unknown stacking mode' % parameters[0])
+                            return -1
+                        imager.setStackMode(parameters[0], float(parameters[1]) if len(parameters) > 1 else 3.0)
+                    elif command == 'encoding':
+                        if parameters[0] not in ENCODINGS:
+                            self.__error('%s: unknown encoding' % parameters[0])
+                            return -1
+                        imager.setEncoding(parameters[0])
+                    elif command == 'serial':
+                        res=self.sendSerial(parameters)
+                    elif command == 'single':
+                        res=self.commandSingle(parameters)
+                    elif command == 'series':
+                        res=self.commandSeries(parameters)
+                    else:
+                        self.__error('%s: unknown command' % command)
+                        return -1
+
+                    if res != 0:
+                        return -1
+
+                    if self.stopFlag.isSet():
+                        self.__debug('abort flag was set in runScript, aborting ...')
+                        return -1
+        finally:
+            imager.closeSession()
+            # wait for the files of the last points before reporting anything
+            if not imager.stopOutputWriter():
+                self.__error('Some output files could not be written!')
 
         self.__info('## Script ended %s ## \n' % time.asctime())
 
@@ -309,6 +486,43 @@ class LifeTimeFrame(wx.Frame):
         os.chdir(newdir)
         return 0
 
+    def __captureFrames(self):
+        # with a SNR target frames() is only the limit, unless maxframes() is set
+        if self.snr and self.maxframes:
+            return self.maxframes
+        return self.frames
+
+    def __prepareDark(self, imager, delay):
+        '''Look up the background for the current settings, taking it when missing or too old'''
+        if self.darkDelay == None:
+            imager.setDark(None)
+            return 0
+
+        imager.setFrames(self.frames)
+        videoGain = self.parent.spin_ctrl_VideoGain.GetValue()
+        key = imager.darkKey(self.exptime*1e-9, self.mcp, videoGain)
+        dark = self.darkLibrary.get(key)
+        if dark is None:
+            self.__info('Taking background at %i ps delay\n' % self.darkDelay)
+            self.parent.camera.SetExposureDelay(self.darkDelay*1e-12)
+            dark = imager.captureDark()
+            self.parent.camera.SetExposureDelay(delay*1e-12)
+            if dark is None:
+                self.__error('LifetimeImager returned an error!')
+                return -1
+            self.darkLibrary.put(key, dark)
+
+        imager.setDark(dark)
+        return 0
+
+    def __prepareFlat(self, imager):
+        '''Hand the reciprocal flat for the current MCP voltage to the imager'''
+        if self.flatLibrary == None:
+            imager.setFlatField(None)
+        else:
+            imager.setFlatField(self.flatLibrary.get(self.mcp, imager.roi, imager.binning), self.mcp)
+        return 0
+
     def commandSingle(self,parameters):
 
         if self.frames == None:
@@ -338,18 +552,25 @@ class LifeTimeFrame(wx.Frame):
                'mcp is %i V, ' % self.mcp + \
                'save as %s\n' % filename)
 
-        self.parent.camera.SetExposureDelay(delay*1e-12)
-        self.__debug('self.parent.camera.SetExposureDelay(%e)' % (delay*1e-12))
-        self.parent.camera.SetExposureTime(self.exptime*1e-9)
-        self.__debug('self.parent.camera.SetExposureTime(%e)' % (self.exptime*1e-9))
-        self.parent.camera.SetGain(self.mcp)
-        self.__debug('self.parent.camera.SetGain(%i)' % (self.mcp))
+        changed=self.parent.camera.configure(exptime=self.exptime*1e-9,delay=delay*1e-12,gain=self.mcp)
+        self.__debug('self.parent.camera.configure(exptime=%e, delay=%e, gain=%i) sent %s'
+                     % (self.exptime*1e-9, delay*1e-12, self.mcp, changed))
+
+        if self.__prepareDark(self.lifetimeImagerFactory.getCamera(), delay) != 0:
+            return -1
+        self.__prepareFlat(self.lifetimeImagerFactory.getCamera())
 
         #self.__info('  imagegrab -n %i ' % self.frames + \
         #      '-t %i ' % self.threshold + '-o %s\n' % filename)
         self.__debug('filename: %s' % filename)
         self.__debug('frames: %d' % self.frames)
-        ret = self.lifetimeImagerFactory.getCamera().setFrames(self.frames).setFilename(filename).capture()
+        # read the ICCD state back while the frames come in, when readback(1) asked for it
+        readback = self.parent.camera.submit('status', 0) if self.readback else None
+        ret = self.lifetimeImagerFactory.getCamera().setFrames(self.__captureFrames()).setFilename(filename)\
+            .setSnrTarget(self.snr, self.snrroi)\
+            .setMetadata([('mcp', '%f' % self.mcp),
+                          ('exptime', '%e' % (self.exptime*1e-9)),
+                          ('delay', '%e' % (delay*1e-12))]).capture()
 
         '''ret=subprocess.call([self.parent.exedir + '/imagegrab.exe',\
                          '-n',\
@@ -361,14 +582,8 @@ class LifeTimeFrame(wx.Frame):
         if ret != True:
             self.__error('LifetimeImager returned an error!')
             return -1
-        else:
-            # append the MCP information to the generated filename.txt
-            f=file(filename+'.txt','a')
-            f.write("mcp = %f\n" % self.mcp)
-            f.write("exptime = %e\n" % (self.exptime*1e-9))
-            f.write("delay = %e\n" % (delay * 1e-12))
-            f.close()
 
+        self.__checkReadback(readback, delay)
         return 0
 
     def commandSeries(self,parameters):
@@ -402,47 +617,92 @@ class LifeTimeFrame(wx.Frame):
             self.__error('Startime > Stoptime!')
             return -1
 
+        cube = None
+        if self.cube:
+            points = 0
+            d = start
+            while d <= stop:
+                points += 1
+                d += step
+            cube = SeriesCube.create(self.filename, points, self.__captureFrames())
+            self.__info('Saving series to data cube %s.cube.npy\n' % self.filename)
+
         d = start # in ps
-        self.parent.camera.SetExposureTime(self.exptime*1e-9)
-        self.__debug('self.parent.camera.SetExposureTime(%e)' % (self.exptime*1e-9))
-        self.parent.camera.SetGain(self.mcp)
-        self.__debug('self.parent.camera.SetGain(%i)' % (self.mcp))
-
-        while d <= stop:
-            if self.stopFlag.isSet():
-                self.__debug('abort flag was found in series(), aborting ...')
-                return 0
+        point = 0
+        # the first point goes out with the other settings, in one batch
+        changed=self.parent.camera.configure(exptime=self.exptime*1e-9,delay=d*1e-12,gain=self.mcp)
+        self.__debug('self.parent.camera.configure(exptime=%e, delay=%e, gain=%i) sent %s'
+                     % (self.exptime*1e-9, d*1e-12, self.mcp, changed))
+        self.__prepareFlat(self.lifetimeImagerFactory.getCamera())
+
+        try:
+            while d <= stop:
+                if self.stopFlag.isSet():
+                    self.__debug('abort flag was found in series(), aborting ...')
+                    return 0
             
-            self.parent.camera.SetExposureDelay(d*1e-12)
-            self.__debug('self.parent.camera.SetExposureDelay(%e)' % (d*1e-12))
-
-            #self.__info('  imagegrab -n %i ' % self.frames +\
-            #     '-t %i ' % self.threshold + '-o %i' % d + 'ps\n')
-            imager = self.lifetimeImagerFactory.getCamera().setFrames(self.frames).setFilename('%s%ips' % (self.filename,int(d)))
-            ret = imager.capture()
-            '''
-            ret=subprocess.call([self. parent.exedir + '/imagegrab.exe',\
-                                 '-n',\
-                                 '%i' % self.frames,\
-                                 '-t',\
-                                 '%i' % self.threshold,\
-                                 '-o',\
-                                 '%i' % int(d) + 'ps'])
-            '''
-            if ret == False:
-                self.__error('LifetimeImager returned an error!')
-                return -1
-            else:
-                # append the MCP information to the generated filename.txt
-                f=file('%s%ips.txt' % (self.filename,int(d)),'a')
-                f.write("mcp = %f\n" % self.mcp)
-                f.write("exptime = %e\n" % (self.exptime*1e-9))
-                f.write("delay = %e\n" % (d*1e-12))
-                f.close()
-                
-            d += step
+                self.parent.camera.SetExposureDelay(d*1e-12)
+                self.__debug('self.parent.camera.SetExposureDelay(%e)' % (d*1e-12))
 
-        return 0
+                # only takes a background on the first point or when the stored one got too old
+                if self.__prepareDark(self.lifetimeImagerFactory.getCamera(), d) != 0:
+                    return -1
+
+                #self.__info('  imagegrab -n %i ' % self.frames +\
+                #     '-t %i ' % self.threshold + '-o %i' % d + 'ps\n')
+                imager = self.lifetimeImagerFactory.getCamera().setFrames(self.__captureFrames()).setFilename('%s%ips' % (self.filename,int(d)))\
+                    .setSnrTarget(self.snr, self.snrroi)\
+                    .setMetadata([('mcp', '%f' % self.mcp),
+                                  ('exptime', '%e' % (self.exptime*1e-9)),
+                                  ('delay', '%e' % (d*1e-12))])\
+                    .setSeriesPoint(cube, point, d*1e-12, self.exptime*1e-9, self.mcp)
+                readback = self.parent.camera.submit('status', 0) if self.readback else None
+                ret = imager.capture()
+                imager.setSeriesPoint(None)
+                '''
+                ret=subprocess.call([self. parent.exedir + '/imagegrab.exe',\
+                                     '-n',\
+                                     '%i' % self.frames,\
+                                     '-t',\
+                                     '%i' % self.threshold,\
+                                     '-o',\
+                                     '%i' % int(d) + 'ps'])
+                '''
+                if ret == False:
+                    self.__error('LifetimeImager returned an error!')
+                    return -1
+
+                self.__checkReadback(readback, d)
+                d += step
+                point += 1
+
+            return 0
+        finally:
+            if cube is not None:
+                # the writer thread may still be appending the last points
+                self.lifetimeImagerFactory.getCamera().waitForOutput()
+                cube.close()
+
+    def __parseLine(self, text):
+        '''Split a script line into its command and parameters, None if it is not command(p1,p2,...)'''
+        # parameters may be paths, so anything but brackets is allowed
+        match = re.match(r'^(\w+)\(([^()]*)\)$', text.strip())
+        if match is None:
+            return None
+        return [match.group(1), [p.strip() for p in match.group(2).split(',')]]
+
+    def __checkReadback(self, readback, delay):
+        '''Warn if the ICCD did not report the delay (in ps) the image was taken at'''
+        if readback is None:
+            return
+        # only advisory, a serial error here must not end the measurement
+        try:
+            status = readback.wait()
+        except Exception, e:
+            self.__info('Could not read the ICCD status back: %s\n' % e)
+            return
+        if status.delay == 'unknown' or abs(status.delay*1e12 - delay) > max(1, 1e-3*abs(delay)):
+            self.__info('Warning: ICCD reported a delay of %s s, expected %e s\n' % (status.delay, delay*1e-12))
 
     def __error(self,text):
         dlg=wx.MessageDialog(self,text,'Error', wx.OK | wx.ICON_ERROR | wx.STAY_ON_TOP)
@@ -515,7 +775,9 @@ class MainFrame(wx.Frame):
                 self.Destroy()
 
         try:
-            self.camera = stanford.StanfordPicos4('COM1')
+            # the GUI and the measurement thread both use the camera, all
+            # serial traffic goes through one owner thread
+            self.camera = instrument.Shared(stanford.StanfordPicos4('COM1'))
         except:
             self.__showError()
             self.Destroy()
@@ -610,25 +872,26 @@ class MainFrame(wx.Frame):
         dlg.ShowModal()
 
     def setupCamera(self, event): # wxGlade: MainFrame.<event_handler>
-        t=int(float(self.text_ctrl_ExpTime.GetValue())*\
+        # the ICCD may have been power cycled or changed on the front panel
+        self.camera.refreshShadow()
+
+        exptime=int(float(self.text_ctrl_ExpTime.GetValue())*\
               self.__getExponent(self.choice_ExpTime))
-        self.camera.SetExposureTime(t*1e-12)
 
-        t=int(float(self.text_ctrl_DelayTime.GetValue())*\
+        delay=int(float(self.text_ctrl_DelayTime.GetValue())*\
               self.__getExponent(self.choice_DelayTime))
-        self.camera.SetExposureDelay(t*1e-12)
 
-        t=int(self.text_ctrl_Gain.GetValue())
-        self.camera.SetGain(t)
+        gain=int(self.text_ctrl_Gain.GetValue())
 
-        t=self.choice_TriggerSource.GetSelection()
-        if t == 1:
-            self.camera.SetTriggerSource('external')
+        if self.choice_TriggerSource.GetSelection() == 1:
+            trigger='external'
         else:
-            self.camera.SetTriggerSource('Fsync')
+            trigger='Fsync'
+
+        # only the settings that changed since the last setup are sent
+        self.camera.configure(exptime=exptime*1e-12,delay=delay*1e-12,gain=gain,
+                              trigger=trigger,videoGain=self.spin_ctrl_VideoGain.GetValue())
 
-        t = self.spin_ctrl_VideoGain.GetValue()
-        self.camera.SetVideoGain(t)
     def setDoBlur(self, event):
         self.ltframe.lifetimeImagerFactory.getCamera().setDoBlur(self.checkbox_doBlur.IsChecked())
 
@@ -670,6 +933,10 @@ class MainFrame(wx.Frame):
             self.ltframe.lifetimeImagerFactory.getCamera().preview()
 
     def onClose(self,event):
+        try:
+            self.camera.close()
+        except:
+            pass
         self.Destroy()
         
 
@@ -1,9 +1,16 @@
 import numpy as np
-import scipy.io
 import cv2
 import time
+import os
 from ctypes import *
 from pyicic.IC_ImagingControl import IC_ImagingControl
+from pyicic.IC_GrabberDLL import IC_GrabberDLL
+from pyicic.IC_Camera import C_FRAME_READY_CALLBACK
+from acquisition import FrameAccumulator, LiveDisplay, AcquisitionPipeline, DirectAcquisition, FrameSink, SnrTarget, scaleImage, frameIntervalStats, reduceImage, frameClock
+from badpixels import BadPixelMap
+from output import OutputWriter, RawFrameRecorder, encodeImage, ENCODINGS
+from darks import DarkLibrary, subtractDark
+from flatfield import applyFlatField
 
 class LifetimeImagerFactory:
 	def __init__(self):
@@ -15,9 +22,10 @@ class LifetimeImagerFactory:
 			icic.init_library()
 			if (len(icic.get_unique_device_names()) > 0):
 				print("Imaging Source camera found")
-				icic.close_library()
-				self.imager = ImagingSourceImager()
+				# hand the open library to the imager instead of initialising it twice
+				self.imager = ImagingSourceImager(icic)
 			else:
+				icic.close_library()
 				raise Exception("Cannot instantiate a camera. Imaging Source not detected. Opticstar nonfunctional.")
 		return self.imager
 
@@ -35,11 +43,59 @@ class LifetimeImager(object):
 		self.inPreview = False
 		self.doBlur = False
 		self.blurSize = 3
+		self.roi = None
+		self.binning = 1
+		self.accumulator = FrameAccumulator()
+		self.refreshRate = 10
+		self.ringSlots = 8
+		self.frameTimeout = 3.0
+		self.overflows = 0
+		self.delivered = 0
+		self.dropped = 0
+		self.frameSink = None
+		self.timestamps = []
+		self.triggerPeriod = None
+		self.metadata = []
+		self.outputWriter = None
+		self.seriesPoint = None
+		self.recordRaw = False
+		self.encoding = 'scaled'
+		self.trackVariance = False
+		self.videoFormat = None
+		self.snrTarget = None
+		self.dark = None
+		self.flatField = None
+		self.flatFieldVoltage = None
+		self.lastImage = None
+		self.rawBuffer = None
+		self.badPixelMap = BadPixelMap()
+		self.badPixelsOnSum = False
+		self.deferCorrections = False
+		self.zeroCopy = False
+		self.sessionOpen = False
 
 	def setDoBlur(self, doBlur):
 		self.doBlur = doBlur
 		return self
                 
+	def setRefreshRate(self, refreshRate):
+		self.refreshRate = refreshRate
+		return self
+
+	def setRingSlots(self, ringSlots):
+		self.ringSlots = ringSlots
+		return self
+
+	def setFrameTimeout(self, frameTimeout):
+		'''Fail a capture when no frame arrived for this many s'''
+		self.frameTimeout = frameTimeout
+		return self
+
+	def setTriggerPeriod(self, triggerPeriod):
+		'''Expected time between triggers in s, None to estimate it from the frames'''
+		self.triggerPeriod = triggerPeriod
+		return self
+
 	def setFrames(self, frames):
 		self.frames = frames
 		return self
@@ -56,13 +112,155 @@ class LifetimeImager(object):
 		return self
 
 	def selfSetBadPixels(self, badPixels):
-		self.badPixels = badPixels
+		self.badPixelMap = BadPixelMap(badPixels, self.badPixelMap.mode)
+		return self
+
+	def setBadPixelMode(self, mode):
+		self.badPixelMap.setMode(mode)
+		return self
+
+	def setBadPixelsOnSum(self, badPixelsOnSum):
+		self.badPixelsOnSum = badPixelsOnSum
+		return self
+
+	def setDeferCorrections(self, deferCorrections):
+		self.deferCorrections = deferCorrections
 		return self
+
+	def setZeroCopy(self, zeroCopy):
+		self.zeroCopy = zeroCopy
+		return self
+
+	def defersCorrections(self):
+		# bad pixels, trim and rotation are defined on full frames, so a reduced
+		# frame has to be corrected before it is cropped and binned
+		return self.deferCorrections and not self.isReducing()
+
+	def isZeroCopy(self):
+		# per-frame corrections write into the frame and the ring hands frames to another
+		# thread, both need a private copy of the driver buffer
+		return self.zeroCopy and self.defersCorrections()
+
+	def setRoi(self, roi):
+		'''Only keep the (x, y, width, height) rectangle of every corrected frame, None for all of it'''
+		self.roi = tuple(int(v) for v in roi) if roi is not None else None
+		return self
+
+	def setBinning(self, binning):
+		'''Sum binning x binning pixel blocks of every frame before accumulating it'''
+		if binning < 1:
+			raise ValueError("Binning must be at least 1")
+		self.binning = int(binning)
+		return self
+
+	def isReducing(self):
+		return self.roi is not None or self.binning > 1
+
+	def reduceFrame(self, arr):
+		if (not self.isReducing()):
+			return arr
+		return reduceImage(arr, self.roi, self.binning)
 		
 	def setFilename(self, filename):
 		self.filename = filename
 		return self
 
+	def setMetadata(self, metadata):
+		'''Extra (key, value) lines for the .txt sidecar of the next capture'''
+		self.metadata = metadata
+		return self
+
+	def setSeriesPoint(self, cube, point=0, delay=0, exptime=0, mcp=0):
+		'''Save the next captures as a point of a SeriesCube instead of separate files, None to stop'''
+		self.seriesPoint = (cube, point, delay, exptime, mcp) if cube is not None else None
+		return self
+
+	def setEncoding(self, encoding):
+		'''Set the image file format, one of output.ENCODINGS'''
+		if encoding not in ENCODINGS:
+			raise ValueError("Output encoding must be one of %s" % ", ".join(sorted(ENCODINGS)))
+		self.encoding = encoding
+		return self
+
+	def setTrackVariance(self, trackVariance):
+		'''Also save the per-pixel variance and SNR of every capture'''
+		self.trackVariance = trackVariance
+		self.accumulator.trackVariance = trackVariance
+		return self
+
+	def setStackMode(self, mode, clipSigma=3.0):
+		'''Combine frames by plain sum, sigma clipped mean ('clip') or approximate median'''
+		self.accumulator.setMode(mode)
+		self.accumulator.clipSigma = clipSigma
+		return self
+
+	def setSnrTarget(self, snr, roi=None):
+		'''Stop capturing once the ROI reaches this SNR, frames is then the maximum. None to always take all frames'''
+		self.snrTarget = SnrTarget(snr, roi) if snr else None
+		return self
+
+	def setDark(self, dark):
+		'''Per-frame dark image to subtract from the following captures, None for none'''
+		self.dark = dark
+		return self
+
+	def setFlatField(self, reciprocal, mcp=None):
+		'''Reciprocal flat map to multiply the final image with, None for none. mcp only goes to the sidecar'''
+		self.flatField = reciprocal
+		self.flatFieldVoltage = mcp if reciprocal is not None else None
+		return self
+
+	def darkKey(self, exptime, mcp, videoGain):
+		'''DarkLibrary key for the current frames, trim and blur settings'''
+		return DarkLibrary.key(exptime, mcp, videoGain, self.frames,
+							   self.trim if self.doTrim else 0, self.blurSize if self.doBlur else 0,
+							   self.roi, self.binning)
+
+	def captureDark(self):
+		'''Capture a dark image with the current settings without saving it and return it
+		as the float32 mean of one frame. Returns None on error'''
+		(dark, snrTarget, flatField, recordRaw) = (self.dark, self.snrTarget, self.flatField, self.recordRaw)
+		self.dark = None
+		self.snrTarget = None
+		self.flatField = None
+		# the filename is still the previous point's, do not overwrite its raw frames
+		self.recordRaw = False
+		try:
+			if not self.capture(save=False) or self.lastImage is None:
+				return None
+			return (self.lastImage / float(max(self.accumulator.count, 1))).astype(np.float32)
+		finally:
+			(self.dark, self.snrTarget, self.flatField, self.recordRaw) = (dark, snrTarget, flatField, recordRaw)
+
+	def setRecordRaw(self, recordRaw):
+		'''Also keep every raw frame, in <filename>.raw.npy'''
+		self.recordRaw = recordRaw
+		return self
+
+	def setOutputWriter(self, outputWriter):
+		self.outputWriter = outputWriter
+		return self
+
+	def startOutputWriter(self, maxPending=4):
+		'''Write output on a background thread until stopOutputWriter()'''
+		if (self.outputWriter is None):
+			self.outputWriter = OutputWriter(self.writeOutput, maxPending)
+		return self
+
+	def waitForOutput(self):
+		'''Wait until everything captured so far is written'''
+		if (self.outputWriter is not None):
+			self.outputWriter.join()
+		return self
+
+	def stopOutputWriter(self):
+		'''Wait for pending output. Returns False if any of it failed to write'''
+		ok = True
+		if (self.outputWriter is not None):
+			ok = self.outputWriter.close()
+			self.outputWriter = None
+		return ok
+
 	def setTrim(self, trim):
 		self.trim = trim
 		return self
@@ -78,66 +276,261 @@ class LifetimeImager(object):
 	def initCamera(self):
 		raise Exception("Please override this method")
 
-	def captureFrame(self):
+	def rawShape(self):
+		raise Exception("Please override this method")
+
+	def frameView(self):
 		raise Exception("Please override this method")
+
+	def grabFrame(self, out):
+		np.copyto(out, self.frameView())
+		return out
+
+	def processFrame(self, raw):
+		return self.reduceFrame(raw)
+
+	def repairsSum(self):
+		# a per-frame blur would spread a bad pixel before the repair on the sum
+		return self.doBadPixels and self.badPixelsOnSum and not self.isReducing() and not self.doBlur
+
+	def processSum(self, total):
+		if (self.repairsSum()):
+			self.badPixelMap.apply(total)
+		return total
+
+	def processVariance(self, variance):
+		variance = np.array(variance)
+		if (self.repairsSum()):
+			self.badPixelMap.apply(variance)
+		return variance
+
+	def displayTransform(self):
+		return None
+
+	def correctedView(self, arr):
+		'''View of an accumulated plane in saved image coordinates, without corrections'''
+		return arr
+
+	def captureFrame(self):
+		shape, dtype = self.rawShape()
+		if (self.rawBuffer is None or self.rawBuffer.shape != shape):
+			self.rawBuffer = np.empty(shape, dtype)
+		self.grabFrame(self.rawBuffer)
+		return self.processFrame(self.rawBuffer)
 		
 	def closeCamera(self):
 		raise Exception("Please override this method")
+
+	def flushFrames(self):
+		pass
+
+	def hasFrameCallback(self):
+		return False
+
+	def openSession(self):
+		'''Open the camera once and keep it live until closeSession()'''
+		if (not self.sessionOpen):
+			self.initCamera()
+			self.sessionOpen = True
+		return self
+
+	def closeSession(self):
+		if (self.sessionOpen):
+			self.sessionOpen = False
+			self.closeCamera()
+		return self
+
+	def startAccumulation(self):
+		'''Drop any frame already waiting in the driver and start a new sum'''
+		if (not self.sessionOpen):
+			self.initCamera()
+		self.flushFrames()
+		self.accumulator.reset()
+
+	def endAccumulation(self):
+		if (not self.sessionOpen):
+			self.closeCamera()
 		
 	def saveOutput(self, total, img, i, now):
-		self.elapsed = time.time() - now
+		self.elapsed = frameClock() - now
 		print("Capture finished in %0.2f seconds" % (self.elapsed))
-		if self.writeImage:
-			cv2.imwrite(self.filename + ".png", img)
-		#image = (65536 * (image - image.min())/(image.max()-image.min())).astype(np.uint16)
-		scaleFactor = 1;
-		if (total.max() > 65536):
-			scaleFactor = total.max() / 65536
-		image = (total / scaleFactor).astype(np.uint16)
-		scipy.io.savemat(self.filename + ".mat", mdict={'image': image})
+		record = self.outputRecord(total, img, i, now)
+		if (self.outputWriter is not None):
+			self.outputWriter.put(record)
+		else:
+			self.writeOutput(record)
+
+	def outputRecord(self, total, img, i, now):
+		'''Collect everything saveOutput() writes, so it can be written on another thread'''
+		# subdir() may chdir before a background writer gets to this record
+		variance = self.accumulator.variance() if self.trackVariance else None
+		return {'filename': os.path.abspath(self.filename),
+				'total': np.array(total),
+				'img': img if self.writeImage else None,
+				'frames': i,
+				'date': self.timestamp,
+				'elapsed': self.elapsed,
+				'width': total.shape[1],
+				'height': total.shape[0],
+				'trim': self.trim if self.doTrim else 0,
+				'roi': self.roi,
+				'binning': self.binning,
+				'blur': self.blurSize if self.doBlur else 0,
+				'overflows': self.overflows,
+				'delivered': self.delivered,
+				'dropped': self.dropped,
+				# arrival time of every frame in s after the capture started
+				'timestamps': np.asarray(self.timestamps, np.float64) - now,
+				'triggerPeriod': self.triggerPeriod,
+				'start': now,
+				'metadata': list(self.metadata),
+				'series': self.seriesPoint,
+				'encoding': self.encoding,
+				'variance': self.processVariance(variance) if variance is not None else None,
+				'stack': self.accumulator.mode,
+				'videoFormat': self.videoFormat,
+				'dark': self.dark is not None,
+				'flat': self.flatFieldVoltage if self.flatField is not None else None,
+				'snr': (self.snrTarget.target, self.snrTarget.snr) if self.snrTarget is not None else None}
+
+	def writeOutput(self, record):
+		filename = record['filename']
+		total = record['total']
+		if record['series'] is not None:
+			(cube, point, delay, exptime, mcp) = record['series']
+			intervals = frameIntervalStats(record['timestamps'], record['triggerPeriod'])
+			cube.append(point, total, delay, exptime, mcp, record['frames'],
+						record['start'], record['elapsed'], record['timestamps'],
+						record['delivered'], record['dropped'], intervals['missed'], intervals['max'])
+			print("Output saved to %s.cube.npy, point %d" % (cube.name, point))
+			skipped = [name for (name, used) in [("encoding %s" % record['encoding'], record['encoding'] != 'scaled'),
+												 ("variance", record['variance'] is not None),
+												 (".png image", record['img'] is not None)] if used]
+			if (len(skipped) > 0):
+				print("Warning: the series cube only holds the raw sum, %s not saved" % ", ".join(skipped))
+			return
+		if record['img'] is not None:
+			cv2.imwrite(filename + ".png", record['img'])
+		extra = {}
+		if record['variance'] is not None:
+			variance = record['variance']
+			noise = np.sqrt(record['frames'] * variance)
+			snr = np.divide(total, noise, out=np.zeros(noise.shape, np.float32), where=noise > 0)
+			extra = {'variance': variance.astype(np.float32), 'snr': snr.astype(np.float32)}
+		scaleFactor = encodeImage(filename, total, record['timestamps'], record['encoding'], extra)
+		intervals = frameIntervalStats(record['timestamps'], record['triggerPeriod'])
 		textFile = None
 		try:
-			textFile = open(self.filename + ".txt", "w")
-			textFile.write("frames = %d\n" % i)
-			textFile.write("date = %s\n" % self.timestamp)
-			textFile.write("timeTaken = %0.2fs\n" % self.elapsed)
-			textFile.write("width = %d\n" % (self.imgWidth - 2*(self.trim if self.doTrim else 0)))
-			textFile.write("height = %d\n" % (self.imgHeight - 2*(self.trim if self.doTrim else 0)))
+			textFile = open(filename + ".txt", "w")
+			textFile.write("frames = %d\n" % record['frames'])
+			textFile.write("date = %s\n" % record['date'])
+			textFile.write("timeTaken = %0.2fs\n" % record['elapsed'])
+			textFile.write("width = %d\n" % record['width'])
+			textFile.write("height = %d\n" % record['height'])
 			textFile.write("scaleFactor = %0.3f\n" % (scaleFactor))
-			textFile.write("trim = %d\n" % (self.trim if self.doTrim else 0))
-			textFile.write("blur = %d\n" % (self.blurSize if self.doBlur else 0))
+			textFile.write("encoding = %s\n" % record['encoding'])
+			textFile.write("stack = %s\n" % record['stack'])
+			textFile.write("videoFormat = %s\n" % record['videoFormat'])
+			textFile.write("darkSubtracted = %d\n" % record['dark'])
+			if record['flat'] is not None:
+				textFile.write("flatField = %s\n" % record['flat'])
+			if record['snr'] is not None:
+				textFile.write("snrTarget = %0.2f\n" % record['snr'][0])
+				textFile.write("snr = %0.2f\n" % record['snr'][1])
+			textFile.write("trim = %d\n" % record['trim'])
+			if record['roi'] is not None:
+				textFile.write("roi = %d %d %d %d\n" % record['roi'])
+			textFile.write("binning = %d\n" % record['binning'])
+			textFile.write("blur = %d\n" % record['blur'])
+			textFile.write("overflows = %d\n" % record['overflows'])
+			textFile.write("delivered = %d\n" % record['delivered'])
+			textFile.write("dropped = %d\n" % record['dropped'])
+			textFile.write("intervalMean = %0.6fs\n" % intervals['mean'])
+			textFile.write("intervalP99 = %0.6fs\n" % intervals['p99'])
+			textFile.write("intervalMax = %0.6fs\n" % intervals['max'])
+			textFile.write("triggerPeriod = %0.6fs\n" % intervals['period'])
+			textFile.write("missed = %d\n" % intervals['missed'])
+			for (key, value) in record['metadata']:
+				textFile.write("%s = %s\n" % (key, value))
 		finally:
 			try:
 				textFile.close()
 			except Exception:
 				print("textFile cannot be closed")
-		print("Output saved to %s" % (self.filename))
+		print("Output saved to %s" % (filename))
 		
-	def capture(self):
+	def capture(self, save=True):
 		print("Displaying (not saving) scaled image.")
+		# the SNR target needs the per-pixel variance
+		self.accumulator.trackVariance = self.trackVariance or self.snrTarget is not None
 		try:
-			self.initCamera()
+			self.startAccumulation()
 			try:
 				print("Camera started")
-				i = 0
-				total = None
-				now = time.time()
-				while(i < self.frames):
-					i += 1
-					frame = self.captureFrame()
-					if (total == None):
-						total = np.ndarray([len(frame), len(frame[0])], "uint32")
-					total = np.add(frame, total);
-					#img = np.divide(total,i).astype("uint8");
-					img = (255 * (total - total.min()) / (total.max() - total.min())).astype("uint8");
-					cv2.imshow('Image', img) 
-					if (cv2.waitKey(1) == 27):
-						break					
-				self.saveOutput(total, img, i, now)
+				if (self.deferCorrections and self.isReducing()):
+					print("ROI and binning need per-frame corrections, not deferring them")
+				if (self.isZeroCopy()):
+					pipeline = DirectAcquisition(self, self.accumulator)
+				elif (self.hasFrameCallback()):
+					if (self.zeroCopy):
+						print("Zero copy ingest needs deferred corrections, copying frames instead")
+					pipeline = FrameSink(self, self.accumulator, self.ringSlots)
+				else:
+					pipeline = AcquisitionPipeline(self, self.accumulator, self.ringSlots)
+				if (self.snrTarget is not None):
+					self.snrTarget.view = self.correctedView
+					self.snrTarget.dark = self.dark
+					pipeline.target = self.snrTarget.reset()
+				if (self.recordRaw):
+					shape, dtype = self.rawShape()
+					pipeline.recorder = RawFrameRecorder(self.filename + ".raw", self.frames, shape, dtype)
+				# only started once everything that can fail to allocate exists
+				display = LiveDisplay(self.accumulator, self.refreshRate, transform=self.displayTransform())
+				try:
+					display.start()
+					now = frameClock()
+					pipeline.start(self.frames)
+					if (isinstance(pipeline, FrameSink)):
+						self.frameSink = pipeline
+					(delivered, lastFrame) = (0, time.time())
+					while(not pipeline.wait(0.1) and not display.isAborted()):
+						if (pipeline.delivered() != delivered):
+							(delivered, lastFrame) = (pipeline.delivered(), time.time())
+						elif (time.time() - lastFrame > self.frameTimeout):
+							raise Exception("No frame from the camera for %0.1f s, is it triggered?" % self.frameTimeout)
+				finally:
+					self.frameSink = None
+					try:
+						pipeline.stop()
+					finally:
+						display.stop()
+						if (pipeline.recorder is not None):
+							pipeline.recorder.close()
+				i = self.accumulator.count
+				if (i == 0):
+					# aborted before the first frame, there is nothing to save
+					self.lastImage = None
+					print("No frames captured, nothing saved")
+					return True
+				total = self.processSum(self.accumulator.result())
+				if (self.dark is not None):
+					total = subtractDark(np.array(total), self.dark, i)
+				if (self.flatField is not None):
+					total = applyFlatField(total, self.flatField)
+				self.lastImage = total
+				self.overflows = pipeline.overflows()
+				self.delivered = pipeline.delivered()
+				self.dropped = pipeline.dropped()
+				self.timestamps = pipeline.timestamps
+				if (self.overflows > 0):
+					print("Frame ring overflowed %d times, processing is behind the trigger rate" % self.overflows)
+				if (self.dropped > 0):
+					print("%d of %d delivered frames were dropped" % (self.dropped, self.delivered))
+				if (save):
+					self.saveOutput(total, scaleImage(total), i, now)
 				print("Camera stopped")
-				cv2.destroyAllWindows()
 			finally:
-				self.closeCamera()
+				self.endAccumulation()
 			return True
 		except Exception as e:
 			print("An error occurred", e.message)
@@ -146,88 +539,206 @@ class LifetimeImager(object):
 			
 	def preview(self):
 		print("Press escape on preview window to exit")
-		self.initCamera()
+		self.startAccumulation()
 		self.inPreview = True
-		i = 0
-		total = None
-		while(True):
-			i += 1
-			if (i % self.frames == 1 or self.frames == 1):
-				i = i % self.frames
-				total = None
-			frame = self.captureFrame()
-			if (total == None):
-				total = np.ndarray([len(frame), len(frame[0])], "uint32")
-			total = np.add(frame, total);
-			if (self.doScale):
-				img = (255 * (total - total.min()) / (total.max() - total.min())).astype("uint8");
-			elif (total.max() > 255):
-				img = (255 * total / total.max()).astype("uint8")
-			else:
-				img = total.astype("uint8")
-			cv2.imshow('Image', img) 
-			if (cv2.waitKey(1) == 27):
-				break
-		self.closeCamera()
-		cv2.destroyAllWindows()
-		self.inPreview = False
+		display = LiveDisplay(self.accumulator, self.refreshRate, self.doScale, transform=self.displayTransform()).start()
+		try:
+			while(not display.isAborted()):
+				if (self.accumulator.count >= self.frames):
+					self.accumulator.reset()
+				display.autoscale = self.doScale
+				frame = self.captureFrame()
+				self.accumulator.add(frame)
+		finally:
+			display.stop()
+			self.endAccumulation()
+			self.inPreview = False
 		
 class ImagingSourceImager(LifetimeImager):
-	def __init__(self):
+	# video format prefix: (IC sink colour format, pixel type, channels)
+	VIDEO_FORMATS = {'Y16': (4, np.uint16, 1),
+					 'Y800': (0, np.uint8, 1),
+					 'RGB24': (1, np.uint8, 3)}
+
+	def __init__(self, icic=None):
 		super(ImagingSourceImager, self).__init__()
+		self.icic = icic
 		self.trim = 5
 		self.doTrim = True
 		self.doBadPixles = True
-		self.badPixels = [(142,15),(142,16),(142,17),
+		self.badPixelMap = BadPixelMap([(142,15),(142,16),(142,17),
                                   (264,320),(264,321),(264,322),
-                                  (264,323),(264,324),(264,325)]
+                                  (264,323),(264,324),(264,325)])
+		self.videoFormats = ['Y16', 'Y800', 'RGB24']
+		self.videoFormat = None
+		self.pixelType = np.uint8
+		self.useFrameCallback = True
+		self.frameCallback = None
+
+	def setUseFrameCallback(self, useFrameCallback):
+		self.useFrameCallback = useFrameCallback
+		return self
+
+	def hasFrameCallback(self):
+		return self.useFrameCallback and self.frameCallback is not None
+
+	def setVideoFormats(self, videoFormats):
+		'''Set the video formats to try, in order of preference'''
+		unknown = [name for name in videoFormats if name not in self.VIDEO_FORMATS]
+		if (len(unknown) > 0):
+			raise ValueError("Unknown video format %s, use one of %s" % (", ".join(unknown), ", ".join(sorted(self.VIDEO_FORMATS))))
+		self.videoFormats = videoFormats
+		return self
+
+	def negotiateFormat(self):
+		'''Select the first preferred video format the device supports at the current
+		resolution, RGB24 otherwise. Trim, bad pixels and flats depend on the resolution'''
+		size = "%dx%d" % (self.cam.get_video_format_width(), self.cam.get_video_format_height())
+		available = [str(f) for f in self.cam.list_video_formats()]
+		for name in self.videoFormats + ['RGB24']:
+			matching = [f for f in available if f.startswith(name) and size in f]
+			if (len(matching) > 0 or name == 'RGB24'):
+				break
+		(sinkFormat, self.pixelType, self.imgDepth) = self.VIDEO_FORMATS[name]
+		if (len(matching) > 0):
+			self.cam.set_video_format(matching[0])
+		self.cam.set_format(sinkFormat)
+		self.videoFormat = name
+		return name
 	
 	def initCamera(self):
-		self.icic = IC_ImagingControl()
-		self.icic.init_library()
+		if (self.icic is None):
+			self.icic = IC_ImagingControl()
+			self.icic.init_library()
 		cam_names = self.icic.get_unique_device_names()
 		self.camName = cam_names[0]
 		self.cam = self.icic.get_device(self.camName)
+		badPixelMap = BadPixelMap.load(self.camName, mode=self.badPixelMap.mode)
+		if (badPixelMap is not None):
+			print("Loaded %d bad pixels for camera %s" % (len(badPixelMap), self.camName))
+			self.badPixelMap = badPixelMap
 		self.cam.open()
 		self.cam.set_video_norm('PAL_B')
+		self.negotiateFormat()
 		self.imgHeight = self.cam.get_video_format_height()
 		self.imgWidth = self.cam.get_video_format_width()
-		self.imgDepth = 3 # 3 colours for RGB
-		self.bufferSize = self.imgHeight * self.imgWidth * self.imgDepth * sizeof(c_uint8)
+		self.bufferSize = self.imgHeight * self.imgWidth * self.imgDepth * np.dtype(self.pixelType).itemsize
 		self.cam.enable_trigger(True)
 		if not self.cam.callback_registered:
 			self.cam.register_frame_ready_callback()
+		# replace pyicic's callback with one that also feeds the frame sink
+		self.frameCallback = C_FRAME_READY_CALLBACK(self.onFrameReady)
+		IC_GrabberDLL.set_frame_ready_callback(self.cam._handle, self.frameCallback, None)
 		self.cam.enable_continuous_mode(True)
 		self.cam.start_live(show_display=False) # start imaging
-		print("Camera %s initialised. Resolution is %d x %d" % (self.camName, self.imgWidth, self.imgHeight))
+		print("Camera %s initialised. Resolution is %d x %d, format %s" % (self.camName, self.imgWidth, self.imgHeight, self.videoFormat))
 		
+	def saveBadPixels(self):
+		self.badPixelMap.save(self.camName)
+		return self
+
 	def closeCamera(self):
-		self.cam.stop_live()
-		self.icic.close_library()
+		try:
+			self.cam.stop_live()
+			self.cam.close()
+		finally:
+			self.frameCallback = None
+			self.icic.close_library()
+			self.icic = None
+
+	def onFrameReady(self, handle_ptr, p_data, frame_num, data):
+		'''Frame-ready callback, runs on the driver's thread for every delivered frame'''
+		# keep reset_frame_ready/wait_til_frame_ready working for preview and zero copy,
+		# this is what pyicic's own callback does
+		self.cam._frame['ready'] = True
+		self.cam._frame['num'] = frame_num
+		frameSink = self.frameSink
+		if (frameSink is not None):
+			try:
+				frameSink.push(self.bufferView(p_data), frame_num, frameClock())
+			except Exception as e:
+				# ctypes would swallow it silently
+				print("Frame callback failed", e)
+
+	def flushFrames(self):
+		self.cam.reset_frame_ready()
 	
-	def captureFrame(self):
+	def rawShape(self):
+		return (self.imgHeight, self.imgWidth), self.pixelType
+
+	def frameView(self):
+		'''Wait for a frame and return channel 0 as a view on the driver buffer.
+		The view is only valid until the next frame is requested.'''
 		self.cam.reset_frame_ready();
 		self.cam.wait_til_frame_ready(3000);
 
-		img_ptr = self.cam.get_buffer()
+		return self.bufferView(self.cam.get_buffer())
+
+	def bufferView(self, img_ptr):
+		'''Return channel 0 of a driver frame buffer as a strided view'''
 		img_data = cast(img_ptr, POINTER(c_ubyte * self.bufferSize))
 
-		arr = np.ndarray(buffer = img_data.contents, dtype = np.uint8, shape = (self.imgHeight, self.imgWidth, self.imgDepth))
-		arr = arr[:,:,0]
+		arr = np.ndarray(buffer = img_data.contents, dtype = self.pixelType, shape = (self.imgHeight, self.imgWidth, self.imgDepth))
+		return arr[:,:,0]
+
+	def processFrame(self, arr):
+		if (self.defersCorrections()):
+			return arr
+		return self.reduceFrame(self.correctFrame(arr, not self.repairsSum()))
+
+	def processSum(self, total):
+		if (self.defersCorrections()):
+			return self.correctFrame(total)
+		return super(ImagingSourceImager, self).processSum(total)
+
+	def processVariance(self, variance):
+		if (self.defersCorrections()):
+			# the blur of a variance is not the variance of the blur, only fix up the geometry
+			return np.array(self.correctFrame(variance, blur=False))
+		return super(ImagingSourceImager, self).processVariance(variance)
+
+	def displayTransform(self):
+		if (self.defersCorrections()):
+			return lambda img: np.rot90(img, 2)
+		return None
+
+	def correctedView(self, arr):
+		if (not self.defersCorrections()):
+			return arr
 		arr = np.rot90(arr, 2)
-		arr = arr.astype(np.uint8)
 		if (self.doTrim):
 			arr = arr[self.trim:arr.shape[0]-self.trim,self.trim:arr.shape[1]-self.trim]
-		if (self.doBadPixels):
-			for (x,y) in self.badPixels:
-				arr[x,y] = arr[x-1,y]
-		if (self.doBlur):
-			arr = cv2.blur(arr,(self.blurSize,self.blurSize))
+		return arr
+
+	def correctFrame(self, arr, badPixels=True, blur=True):
+		arr = np.rot90(arr, 2)
+		if (self.doTrim):
+			arr = arr[self.trim:arr.shape[0]-self.trim,self.trim:arr.shape[1]-self.trim]
+		if (self.doBadPixels and badPixels):
+			self.badPixelMap.apply(arr)
+		if (self.doBlur and blur):
+			if (arr.dtype == np.uint8 or arr.dtype == np.uint16):
+				arr = cv2.blur(arr,(self.blurSize,self.blurSize))
+			else:
+				arr = np.rint(cv2.blur(arr.astype(np.float64),(self.blurSize,self.blurSize))).astype(arr.dtype)
 			
 		return arr
 
-	
-	
-	
-		
-	
+if __name__ == '__main__':
+	# check that deferred corrections reproduce the per-frame path on synthetic frames
+	frames = [np.random.randint(0, 256, (480, 640)).astype(np.uint8) for n in range(100)]
+	for doBlur in (False, True):
+		results = []
+		for defer in (False, True):
+			imager = ImagingSourceImager().setDoBlur(doBlur).setDeferCorrections(defer)
+			accumulator = FrameAccumulator().reset()
+			for frame in frames:
+				accumulator.add(imager.processFrame(frame.copy()))
+			results.append(imager.processSum(accumulator.total).astype(np.int64))
+		difference = np.abs(results[0] - results[1]).max()
+		print('blur = %s, max difference = %d' % (doBlur, difference))
+		if not doBlur:
+			assert difference == 0, 'deferred corrections are not bit-identical'
+		else:
+			# the per-frame uint8 blur rounds every frame, the deferred blur rounds once
+			assert difference <= len(frames) / 2 + 1, 'deferred blur deviates beyond rounding'
@@ -0,0 +1,656 @@
+import numpy as np
+import cv2
+import threading
+import time
+import sys
+
+# time.time() only ticks every 15.6 ms on Windows, too coarse for 40 ms frame
+# intervals. time.clock() is the performance counter there, offset to wall time
+if sys.platform == 'win32' and hasattr(time, 'clock'):
+	_clock = time.clock
+else:
+	_clock = time.time
+_clockOffset = time.time() - _clock()
+
+def frameClock():
+	'''Wall clock time in s with the best resolution the platform has'''
+	return _clockOffset + _clock()
+
+class FrameAccumulator(object):
+	'''Running sum of frames held in a single preallocated uint32 buffer.
+
+	With trackVariance the per-pixel M2 of Welford's algorithm is kept as
+	well, in one float32 plane. The running mean is not stored, it is the
+	sum divided by the count, and the update is done in blocks of rows so
+	its scratch space stays small.
+
+	Besides the plain 'sum' the accumulator can stack robustly, with memory
+	bounded by a few frame planes however many frames are added:
+	'clip' rejects pixels more than clipSigma standard deviations above the
+	running mean of the values accepted so far (cosmic rays and MCP bursts
+	only ever add counts), with the variance floored at the Poisson level.
+	The first WARMUP frames are kept and clipped around their median once
+	all of them are in, so an early outlier does not set the limits. 'median'
+	tracks an
+	approximate per-pixel median by stochastic approximation. result()
+	returns either as a sum, i.e. the robust mean times the frame count.'''
+
+	BLOCK = 64
+	MODES = ('sum', 'clip', 'median')
+	# frames clipped together around their median before running clipping starts
+	WARMUP = 5
+
+	def __init__(self, dtype=np.uint32, trackVariance=False, mode='sum', clipSigma=3.0):
+		self.dtype = dtype
+		self.trackVariance = trackVariance
+		self.setMode(mode)
+		self.clipSigma = clipSigma
+		self.total = None
+		self.m2 = None
+		self.kept = None
+		self.warmup = None
+		self.median = None
+		self.deviation = None
+		self.scratch = None
+		self.count = 0
+		self.dirty = False
+
+	def setMode(self, mode):
+		if mode not in self.MODES:
+			raise ValueError("Stacking mode must be one of %s" % ", ".join(self.MODES))
+		self.mode = mode
+		self.dirty = True
+		return self
+
+	def reset(self):
+		'''Start a new accumulation. The buffer is kept and zeroed on the next add()'''
+		self.count = 0
+		self.dirty = True
+		return self
+
+	def plane(self, plane, shape, dtype):
+		if plane is None or plane.shape != tuple(shape) or plane.dtype != dtype:
+			return np.zeros(shape, dtype)
+		plane.fill(0)
+		return plane
+
+	def allocate(self, shape):
+		if self.total is None or self.total.shape != tuple(shape):
+			self.total = np.zeros(shape, self.dtype)
+		elif self.dirty:
+			self.total.fill(0)
+		self.m2 = self.plane(self.m2, shape, np.float32) if (self.trackVariance or self.mode == 'clip') else None
+		self.kept = self.plane(self.kept, shape, np.uint32) if self.mode == 'clip' else None
+		self.warmup = self.plane(self.warmup, (self.WARMUP,) + tuple(shape), np.float32) if self.mode == 'clip' else None
+		self.median = self.plane(self.median, shape, np.float32) if self.mode == 'median' else None
+		self.deviation = self.plane(self.deviation, shape, np.float32) if self.mode == 'median' else None
+		if self.scratch is None or self.scratch.shape[1:] != tuple(shape[1:]):
+			self.scratch = np.empty((3, self.BLOCK) + tuple(shape[1:]), np.float32)
+		self.dirty = False
+		return self.total
+
+	def add(self, frame):
+		'''Add a frame to the running sum in place'''
+		if self.dirty or self.total is None or self.total.shape != frame.shape:
+			self.allocate(frame.shape)
+		if self.mode == 'clip':
+			self.addClipped(frame)
+		else:
+			if self.trackVariance and self.count > 0:
+				self.updateM2(frame)
+			if self.mode == 'median':
+				self.updateMedian(frame)
+			np.add(self.total, frame, out=self.total)
+		self.count += 1
+		return self.count
+
+	def blocks(self, frame):
+		for row in range(0, frame.shape[0], self.BLOCK):
+			rows = slice(row, row + self.BLOCK)
+			yield rows, len(self.total[rows])
+
+	def updateM2(self, frame):
+		# with n frames including this one: M2 += (n-1)/n * (x - sum/(n-1))^2
+		n = self.count + 1
+		for (rows, length) in self.blocks(frame):
+			delta = self.scratch[0, :length]
+			np.multiply(self.total[rows], -1.0 / (n - 1), out=delta, casting='unsafe')
+			delta += frame[rows]
+			delta *= delta
+			delta *= (n - 1.0) / n
+			self.m2[rows] += delta
+
+	def addClipped(self, frame):
+		# Welford over the accepted values only, each pixel with its own count
+		if self.count < self.WARMUP:
+			self.warmup[self.count] = frame
+		for (rows, length) in self.blocks(frame):
+			kept = self.kept[rows]
+			mean = self.scratch[0, :length]
+			delta = self.scratch[1, :length]
+			limit = self.scratch[2, :length]
+			np.divide(self.total[rows], np.maximum(kept, 1), out=mean, casting='unsafe')
+			np.subtract(frame[rows], mean, out=delta, casting='unsafe')
+			if self.count < self.WARMUP:
+				accept = np.ones(delta.shape, bool)
+			else:
+				# variance of the accepted values, at least the Poisson variance (the
+				# mean) and one count squared
+				np.divide(self.m2[rows], np.maximum(kept, 2) - 1, out=limit, casting='unsafe')
+				np.maximum(limit, mean, out=limit)
+				np.maximum(limit, 1.0, out=limit)
+				np.sqrt(limit, out=limit)
+				limit *= self.clipSigma
+				# half a count for the integer frames, so e.g. 6.2 does not reject a 6
+				limit += 0.5
+				accept = delta <= limit
+			np.multiply(delta, delta, out=limit)
+			limit *= kept / (kept + 1.0)
+			np.add(self.m2[rows], limit, out=self.m2[rows], where=accept)
+			np.add(self.total[rows], frame[rows], out=self.total[rows], where=accept, casting='unsafe')
+			np.add(kept, 1, out=kept, where=accept, casting='unsafe')
+		if self.count + 1 == self.WARMUP:
+			self.clipWarmup()
+
+	def clipWarmup(self):
+		'''Redo the first WARMUP frames, clipping them around their median'''
+		for (rows, length) in self.blocks(self.warmup[0]):
+			values = self.warmup[:, rows]
+			median = np.median(values, axis=0)
+			# robust spread from the median absolute deviation, floored like addClipped
+			spread = np.median(np.abs(values - median), axis=0) * 1.4826
+			spread = np.maximum(spread, np.sqrt(np.maximum(median, 1.0)))
+			accept = values <= median + self.clipSigma * spread + 0.5
+			kept = accept.sum(axis=0)
+			total = np.where(accept, values, 0).sum(axis=0, dtype=np.float64)
+			mean = total / np.maximum(kept, 1)
+			self.total[rows] = np.rint(total).astype(self.dtype)
+			self.kept[rows] = kept
+			self.m2[rows] = (np.where(accept, values - mean, 0) ** 2).sum(axis=0)
+
+	def updateMedian(self, frame):
+		# m += step * sign(x - m) with a step of the mean absolute deviation / n
+		n = self.count + 1
+		if n == 1:
+			self.median[...] = frame
+			return
+		for (rows, length) in self.blocks(frame):
+			delta = self.scratch[0, :length]
+			step = self.scratch[1, :length]
+			np.subtract(frame[rows], self.median[rows], out=delta, casting='unsafe')
+			np.abs(delta, out=step)
+			step -= self.deviation[rows]
+			step /= n
+			self.deviation[rows] += step
+			np.maximum(self.deviation[rows], 0.5, out=step)
+			step /= n
+			np.sign(delta, out=delta)
+			delta *= step
+			self.median[rows] += delta
+
+	def result(self):
+		'''The stacked image as a sum over all frames, None before the first frame'''
+		if self.count == 0 or self.dirty:
+			return None
+		if self.mode == 'sum':
+			return self.total
+		if self.mode == 'clip':
+			mean = self.total / np.maximum(self.kept, 1).astype(np.float64)
+		else:
+			mean = np.maximum(self.median, 0)
+		return np.rint(mean * self.count).astype(self.dtype)
+
+	def variance(self):
+		'''Per-pixel sample variance of the accumulated frames, None when not tracked'''
+		if self.m2 is None or self.dirty:
+			return None
+		count = self.count if self.mode != 'clip' else np.maximum(self.kept, 1).astype(np.float32)
+		return self.m2 / np.maximum(count - 1, 1)
+
+	def scaled(self, autoscale=True):
+		'''Return the running sum rescaled to uint8 for display, None before the first frame'''
+		if self.count == 0 or self.dirty:
+			return None
+		return scaleImage(self.total, autoscale)
+
+
+def scaleImage(total, autoscale=True):
+	'''Rescale an accumulated image to uint8, stretching min..max when autoscaling'''
+	if total is None:
+		return None
+	low = total.min() if autoscale else 0
+	high = total.max()
+	if high <= low:
+		return np.zeros(total.shape, np.uint8)
+	if not autoscale and high <= 255:
+		return total.astype(np.uint8)
+	return (255.0 * (total - low) / (high - low)).astype(np.uint8)
+
+
+def reduceImage(arr, roi=None, binning=1, average=False):
+	'''Crop arr to roi = (x, y, width, height) and sum, or average, binning x binning pixel blocks.
+	Rows and columns that do not fill a whole block are dropped'''
+	if roi is not None:
+		(x, y, width, height) = roi
+		if x < 0 or y < 0 or x + width > arr.shape[1] or y + height > arr.shape[0]:
+			raise ValueError("ROI %s does not fit a %d x %d image" % (roi, arr.shape[1], arr.shape[0]))
+		arr = arr[y:y+height, x:x+width]
+	if binning > 1:
+		height = arr.shape[0] // binning
+		width = arr.shape[1] // binning
+		blocks = arr[:height*binning, :width*binning].reshape(height, binning, width, binning)
+		if average:
+			return blocks.mean(axis=(1, 3), dtype=np.float32)
+		return blocks.sum(axis=(1, 3), dtype=np.uint32 if arr.dtype.kind == 'u' else arr.dtype)
+	return arr
+
+
+def frameIntervalStats(timestamps, period=None):
+	'''Summarise per-frame arrival times.
+
+	Returns the mean, 99th percentile and maximum interval between frames in
+	seconds, and the number of trigger periods without a frame. When no
+	trigger period is given the median interval is used.'''
+	intervals = np.diff(np.asarray(timestamps, np.float64))
+	if len(intervals) == 0:
+		return {'mean': 0.0, 'p99': 0.0, 'max': 0.0, 'period': period or 0.0, 'missed': 0}
+	if not period:
+		period = float(np.median(intervals))
+	missed = 0
+	if period > 0:
+		missed = int(np.maximum(np.rint(intervals / period) - 1, 0).sum())
+	return {'mean': float(intervals.mean()), 'p99': float(np.percentile(intervals, 99)),
+			'max': float(intervals.max()), 'period': period, 'missed': missed}
+
+
+class SnrTarget(object):
+	'''Decides when an acquisition has reached a target signal to noise ratio.
+
+	update() is called after every frame but only looks at the accumulator
+	every interval frames, so a run may take up to interval - 1 frames more
+	than needed. The SNR is the median over a region of interest (x, y,
+	width, height in saved image coordinates, the whole image if None) of
+	the per-pixel SNR of the sum, sum / sqrt(n * variance), from the
+	accumulator's M2 plane. A per-frame dark is subtracted from the signal
+	first. view maps accumulator planes to saved image coordinates when
+	corrections are deferred.'''
+
+	def __init__(self, target, roi=None, minFrames=10, view=None, dark=None, interval=10):
+		self.target = target
+		self.roi = roi
+		self.minFrames = minFrames
+		self.interval = interval
+		self.view = view
+		self.dark = dark
+		self.reset()
+
+	def reset(self):
+		self.count = 0
+		self.snr = 0.0
+		return self
+
+	def region(self, arr, view=True):
+		if view and self.view is not None:
+			arr = self.view(arr)
+		if self.roi is not None:
+			(x, y, width, height) = self.roi
+			arr = arr[y:y+height, x:x+width]
+		return arr
+
+	def update(self, accumulator):
+		'''Check the accumulator after a frame was added, returns True once the target is reached'''
+		self.count = accumulator.count
+		first = max(self.minFrames, 2)
+		if self.count < first or accumulator.m2 is None:
+			return False
+		if (self.count - first) % max(self.interval, 1) != 0:
+			return False
+		signal = self.region(accumulator.total).astype(np.float64)
+		if accumulator.mode == 'clip':
+			n = self.region(accumulator.kept).astype(np.float64)
+		else:
+			n = float(self.count)
+		if self.dark is not None:
+			signal -= self.region(self.dark, False) * n
+		# n * variance with variance = M2 / (n - 1)
+		noise = self.region(accumulator.m2) * (n / np.maximum(n - 1, 1))
+		np.sqrt(noise, out=noise)
+		snr = np.where(signal > 0, np.inf, 0.0)
+		np.divide(signal, noise, out=snr, where=noise > 0)
+		self.snr = float(np.median(snr))
+		return self.snr >= self.target
+
+
+class LiveDisplay(object):
+	'''Renders an accumulator's running sum on its own thread at a fixed refresh rate.
+
+	All OpenCV window calls happen on the display thread, so the acquisition
+	loop never waits on rendering. Pressing escape sets the aborted event.'''
+
+	def __init__(self, accumulator, refreshRate=10, autoscale=True, window='Image', transform=None):
+		self.accumulator = accumulator
+		self.refreshRate = refreshRate
+		self.autoscale = autoscale
+		self.transform = transform
+		self.window = window
+		self.aborted = threading.Event()
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.aborted.clear()
+		self.stopped.clear()
+		self.thread = threading.Thread(None, self.run, name="LiveDisplay")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def isAborted(self):
+		return self.aborted.isSet()
+
+	def run(self):
+		period = max(1, int(1000.0 / self.refreshRate))
+		try:
+			while not self.stopped.isSet():
+				img = self.accumulator.scaled(self.autoscale)
+				if img is not None:
+					if self.transform is not None:
+						img = self.transform(img)
+					cv2.imshow(self.window, img)
+				if (cv2.waitKey(period) == 27):
+					self.aborted.set()
+		finally:
+			cv2.destroyAllWindows()
+
+
+class FrameRing(object):
+	'''Bounded ring of preallocated frame slots shared by one grabber and one processor.
+
+	When every slot is full the grabber cannot wait, as the camera keeps
+	triggering, so acquire() returns None and the overflow counter is bumped.'''
+
+	def __init__(self, slots, shape, dtype=np.uint8):
+		self.buffers = [np.empty(shape, dtype) for i in range(slots)]
+		self.stamps = [0.0] * slots
+		self.head = 0
+		self.tail = 0
+		self.size = 0
+		self.overflows = 0
+		self.closed = False
+		self.condition = threading.Condition()
+
+	def acquire(self):
+		'''Return the slot to fill next, or None when the ring is full'''
+		with self.condition:
+			if self.size == len(self.buffers):
+				self.overflows += 1
+				return None
+			return self.head
+
+	def commit(self, timestamp=None):
+		'''Publish the slot returned by acquire() to the processor'''
+		with self.condition:
+			self.stamps[self.head] = frameClock() if timestamp is None else timestamp
+			self.head = (self.head + 1) % len(self.buffers)
+			self.size += 1
+			self.condition.notify()
+
+	def get(self, timeout=None):
+		'''Return the oldest filled slot, or None once the ring is closed and drained'''
+		with self.condition:
+			while self.size == 0 and not self.closed:
+				self.condition.wait(timeout)
+			if self.size == 0:
+				return None
+			return self.tail
+
+	def release(self):
+		'''Hand the slot returned by get() back to the grabber'''
+		with self.condition:
+			self.tail = (self.tail + 1) % len(self.buffers)
+			self.size -= 1
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+
+class AcquisitionPipeline(object):
+	'''Grabs frames on one thread and processes/accumulates them on another.
+
+	The grabber only waits for the camera and copies the raw frame into a ring
+	slot (imager.grabFrame), so the exposure of frame N+1 overlaps with the
+	processing of frame N (imager.processFrame and the accumulator).'''
+
+	def __init__(self, imager, accumulator, slots=8):
+		self.imager = imager
+		self.accumulator = accumulator
+		self.slots = slots
+		self.ring = None
+		self.recorder = None
+		self.target = None
+		self.frames = 0
+		self.grabbed = 0
+		self.timestamps = []
+		self.error = None
+		self.stopped = threading.Event()
+		self.finished = threading.Event()
+		self.threads = []
+
+	def start(self, frames):
+		shape, dtype = self.imager.rawShape()
+		self.ring = FrameRing(self.slots, shape, dtype)
+		self.scratch = np.empty(shape, dtype)
+		self.frames = frames
+		self.grabbed = 0
+		self.timestamps = []
+		self.error = None
+		self.stopped.clear()
+		self.finished.clear()
+		self.threads = self.workers()
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+		return self
+
+	def workers(self):
+		return [threading.Thread(None, self.grab, name="FrameGrabber"),
+				threading.Thread(None, self.process, name="FrameProcessor")]
+
+	def wait(self, timeout=None):
+		'''Wait for the requested number of frames. Returns True once finished'''
+		self.finished.wait(timeout)
+		return self.finished.isSet()
+
+	def stop(self):
+		self.stopped.set()
+		if self.ring is not None:
+			self.ring.close()
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+		if self.error is not None:
+			raise self.error
+
+	def overflows(self):
+		return self.ring.overflows if self.ring is not None else 0
+
+	def delivered(self):
+		return self.grabbed + self.overflows()
+
+	def dropped(self):
+		return self.overflows()
+
+	def grab(self):
+		try:
+			while self.grabbed < self.frames and not self.stopped.isSet():
+				slot = self.ring.acquire()
+				if slot is None:
+					# processing is behind, consume the frame so the camera keeps pace
+					self.imager.grabFrame(self.scratch)
+					continue
+				self.imager.grabFrame(self.ring.buffers[slot])
+				self.ring.commit()
+				self.grabbed += 1
+		except Exception as e:
+			self.error = e
+			self.finished.set()
+		finally:
+			self.ring.close()
+
+	def process(self):
+		try:
+			while self.accumulator.count < self.frames:
+				slot = self.ring.get()
+				if slot is None:
+					break
+				if self.recorder is not None:
+					self.recorder.record(self.ring.buffers[slot], self.ring.stamps[slot])
+				frame = self.imager.processFrame(self.ring.buffers[slot])
+				self.accumulator.add(frame)
+				self.timestamps.append(self.ring.stamps[slot])
+				reached = self.target is not None and self.target.update(self.accumulator)
+				self.ring.release()
+				if reached:
+					self.stopped.set()
+					break
+		except Exception as e:
+			self.error = e
+			self.stopped.set()
+			self.ring.close()
+		finally:
+			self.finished.set()
+
+
+class DirectAcquisition(object):
+	'''Accumulates straight from the driver's frame buffer on a single thread.
+
+	imager.frameView() returns a strided view on the driver buffer, which the
+	driver reuses for later frames, so each view is added to the sum before
+	the next frame is requested and is never written to. This is only valid
+	when nothing has to be corrected per frame, see LifetimeImager.isZeroCopy.'''
+
+	def __init__(self, imager, accumulator):
+		self.imager = imager
+		self.accumulator = accumulator
+		self.recorder = None
+		self.target = None
+		self.frames = 0
+		self.timestamps = []
+		self.error = None
+		self.stopped = threading.Event()
+		self.finished = threading.Event()
+		self.thread = None
+
+	def start(self, frames):
+		self.frames = frames
+		self.timestamps = []
+		self.error = None
+		self.stopped.clear()
+		self.finished.clear()
+		self.thread = threading.Thread(None, self.run, name="DirectAcquisition")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def wait(self, timeout=None):
+		self.finished.wait(timeout)
+		return self.finished.isSet()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		if self.error is not None:
+			raise self.error
+
+	def overflows(self):
+		return 0
+
+	def delivered(self):
+		return self.accumulator.count
+
+	def dropped(self):
+		return 0
+
+	def run(self):
+		try:
+			while self.accumulator.count < self.frames and not self.stopped.isSet():
+				frame = self.imager.frameView()
+				timestamp = frameClock()
+				if self.recorder is not None:
+					self.recorder.record(frame, timestamp)
+				self.accumulator.add(frame)
+				self.timestamps.append(timestamp)
+				if self.target is not None and self.target.update(self.accumulator):
+					break
+		except Exception as e:
+			self.error = e
+		finally:
+			self.finished.set()
+
+
+class FrameSink(AcquisitionPipeline):
+	'''Acquisition driven by the driver's frame-ready callback instead of polling.
+
+	The callback calls push() for every frame the driver delivers, so no frame
+	can slip in between resetting and waiting for the ready flag. push() copies
+	the frame into the ring (the driver reuses its buffer) and the processor
+	thread of AcquisitionPipeline accumulates it. Gaps in the driver's frame
+	numbers and frames arriving at a full ring are counted as dropped.'''
+
+	def __init__(self, imager, accumulator, slots=8):
+		super(FrameSink, self).__init__(imager, accumulator, slots)
+		self.armed = False
+		self.received = 0
+		self.missed = 0
+		self.lastNumber = None
+
+	def start(self, frames):
+		self.received = 0
+		self.missed = 0
+		self.lastNumber = None
+		super(FrameSink, self).start(frames)
+		self.armed = True
+		return self
+
+	def workers(self):
+		return [threading.Thread(None, self.process, name="FrameProcessor")]
+
+	def stop(self):
+		self.armed = False
+		super(FrameSink, self).stop()
+
+	def delivered(self):
+		return self.received
+
+	def dropped(self):
+		return self.missed + self.overflows()
+
+	def push(self, frame, number, timestamp=None):
+		'''Called on the driver's thread for every delivered frame'''
+		if not self.armed:
+			return
+		if timestamp is None:
+			timestamp = frameClock()
+		self.received += 1
+		if self.lastNumber is not None and number > self.lastNumber + 1:
+			self.missed += number - self.lastNumber - 1
+		self.lastNumber = number
+		slot = self.ring.acquire()
+		if slot is None:
+			return
+		np.copyto(self.ring.buffers[slot], frame)
+		self.ring.commit(timestamp)
+		self.grabbed += 1
+		if self.grabbed >= self.frames:
+			self.armed = False
+			self.ring.close()
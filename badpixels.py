@@ -0,0 +1,99 @@
+import os
+import re
+import numpy as np
+
+class BadPixelMap(object):
+	'''Bad pixel list compiled into NumPy index arrays for vectorised repair.
+
+	Pixels are (row, column) pairs in processed frame coordinates. In 'copy'
+	mode a bad pixel takes the value of the nearest good pixel above it, which
+	matches the old per-pixel loop and is linear, so it can equally be applied
+	once to the accumulated sum. In 'median' mode it takes the median of its
+	good 8-neighbours.'''
+
+	NEIGHBOURS = [(-1,-1),(-1,0),(-1,1),(0,-1),(0,1),(1,-1),(1,0),(1,1)]
+
+	def __init__(self, pixels=None, mode='copy'):
+		if mode not in ('copy', 'median'):
+			raise ValueError("Bad pixel mode must be either copy or median")
+		self.pixels = [(int(x), int(y)) for (x, y) in (pixels or [])]
+		self.mode = mode
+		self.shape = None
+
+	def __len__(self):
+		return len(self.pixels)
+
+	def setMode(self, mode):
+		if mode not in ('copy', 'median'):
+			raise ValueError("Bad pixel mode must be either copy or median")
+		self.mode = mode
+		self.shape = None
+		return self
+
+	def compile(self, shape):
+		'''Build the destination and source index arrays for a frame shape'''
+		height, width = shape[0], shape[1]
+		bad = set(self.pixels)
+		dst = []
+		src = []
+		for (x, y) in self.pixels:
+			if not (0 <= x < height and 0 <= y < width):
+				continue
+			if self.mode == 'copy':
+				sx = x - 1
+				while (sx, y) in bad:
+					sx -= 1
+				if sx < 0:
+					continue
+				dst.append((x, y))
+				src.append([(sx, y)])
+			else:
+				neighbours = [(x + dx, y + dy) for (dx, dy) in self.NEIGHBOURS
+							  if 0 <= x + dx < height and 0 <= y + dy < width and (x + dx, y + dy) not in bad]
+				if len(neighbours) == 0:
+					continue
+				dst.append((x, y))
+				src.append(neighbours)
+		count = max([len(s) for s in src] + [1])
+		self.dstRows = np.array([d[0] for d in dst], np.intp)
+		self.dstCols = np.array([d[1] for d in dst], np.intp)
+		# pad the ragged neighbour lists to a rectangle, srcValid marks the genuine entries
+		self.srcRows = np.array([[s[min(k, len(s) - 1)][0] for k in range(count)] for s in src], np.intp).reshape(len(src), count)
+		self.srcCols = np.array([[s[min(k, len(s) - 1)][1] for k in range(count)] for s in src], np.intp).reshape(len(src), count)
+		self.srcValid = np.array([[k < len(s) for k in range(count)] for s in src], bool).reshape(len(src), count)
+		self.shape = tuple(shape[:2])
+		return self
+
+	def apply(self, arr):
+		'''Repair the bad pixels of arr in place and return it'''
+		if len(self.pixels) == 0:
+			return arr
+		if self.shape != tuple(arr.shape[:2]):
+			self.compile(arr.shape)
+		if len(self.dstRows) == 0:
+			return arr
+		if self.mode == 'copy':
+			arr[self.dstRows, self.dstCols] = arr[self.srcRows[:,0], self.srcCols[:,0]]
+		else:
+			values = arr[self.srcRows, self.srcCols].astype(np.float32)
+			values[~self.srcValid] = np.nan
+			arr[self.dstRows, self.dstCols] = np.nanmedian(values, axis=1).astype(arr.dtype)
+		return arr
+
+	@staticmethod
+	def filename(serial, directory='.'):
+		return os.path.join(directory, "badpixels_%s.txt" % re.sub(r'[^\w\-]', '_', serial))
+
+	def save(self, serial, directory='.'):
+		np.savetxt(BadPixelMap.filename(serial, directory), np.array(self.pixels, int).reshape(-1, 2), fmt="%d",
+				   header="bad pixels for camera %s, mode = %s (row column)" % (serial, self.mode))
+		return self
+
+	@staticmethod
+	def load(serial, directory='.', mode='copy'):
+		'''Load the bad pixel map saved for a camera serial, or None when there is none'''
+		path = BadPixelMap.filename(serial, directory)
+		if not os.path.exists(path):
+			return None
+		pixels = np.loadtxt(path, dtype=int, ndmin=2)
+		return BadPixelMap([tuple(p) for p in pixels], mode)
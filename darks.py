@@ -0,0 +1,71 @@
+import os
+import time
+import collections
+import numpy as np
+
+class DarkLibrary(object):
+	'''Background images keyed by the settings they were taken with.
+
+	Keys are (exptime, mcp, videoGain, frames, trim, blur, roi, binning) tuples. The most
+	recently used entries are held in memory, least recently used ones are
+	evicted once there are more than capacity, and every entry is also
+	stored as an .npz in directory so later runs can reuse it. Entries older
+	than maxAge seconds count as missing and have to be taken again.'''
+
+	def __init__(self, directory, capacity=8, maxAge=3600):
+		self.directory = os.path.abspath(directory)
+		self.capacity = capacity
+		self.maxAge = maxAge
+		self.cache = collections.OrderedDict()
+
+	@staticmethod
+	def key(exptime, mcp, videoGain, frames, trim, blur, roi=None, binning=1):
+		roi = tuple(int(v) for v in roi) if roi is not None else None
+		return (float(exptime), int(mcp), int(videoGain), int(frames), int(trim), int(blur), roi, int(binning))
+
+	def filename(self, key):
+		name = "dark_t%e_mcp%d_vg%d_n%d_trim%d_blur%d" % key[:6]
+		if key[6] is not None:
+			name += "_roi%d-%d-%d-%d" % key[6]
+		if key[7] > 1:
+			name += "_bin%d" % key[7]
+		return os.path.join(self.directory, name + ".npz")
+
+	def get(self, key):
+		'''Return the dark image for key, or None when it is missing or too old'''
+		if key in self.cache:
+			(image, taken) = self.cache.pop(key)
+		else:
+			path = self.filename(key)
+			if not os.path.exists(path):
+				return None
+			with np.load(path) as data:
+				(image, taken) = (data['image'], float(data['taken']))
+		if self.maxAge is not None and time.time() - taken > self.maxAge:
+			return None
+		self.remember(key, image, taken)
+		return image
+
+	def put(self, key, image):
+		taken = time.time()
+		image = np.array(image)
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		np.savez_compressed(self.filename(key), image=image, taken=taken)
+		self.remember(key, image, taken)
+		return image
+
+	def remember(self, key, image, taken):
+		self.cache.pop(key, None)
+		self.cache[key] = (image, taken)
+		while len(self.cache) > self.capacity:
+			self.cache.popitem(last=False)
+
+
+def subtractDark(total, dark, frames=1):
+	'''Subtract a per-frame dark image from an unsigned sum of frames in place, clipping at zero'''
+	if dark.shape != total.shape:
+		raise ValueError("Dark image is %s but the image is %s" % (dark.shape, total.shape))
+	background = np.rint(dark * float(frames))
+	np.subtract(total, np.minimum(total, background), out=total, casting='unsafe')
+	return total
@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import scipy.io
+
+INDEX_DTYPE = [('delay', np.float64), ('exptime', np.float64), ('mcp', np.float64),
+			   ('frames', np.int64), ('start', np.float64), ('elapsed', np.float64), ('written', np.bool_),
+			   ('delivered', np.int64), ('dropped', np.int64), ('missed', np.int64), ('intervalMax', np.float64)]
+
+class SeriesCube(object):
+	'''All points of a series() run in one memory-mapped data cube.
+
+	<name>.cube.npy holds the images as a (delay x height x width) array, one
+	contiguous chunk per delay point, <name>.index.npy one row of settings and
+	frame statistics per point and <name>.timestamps.npy the frame arrival
+	times (NaN padded).
+	Every file is a preallocated .npy, so a cube is readable while it is still
+	being filled and after an aborted run; the 'written' column marks the
+	points that were saved.'''
+
+	def __init__(self, name, points, frames, mode='r'):
+		self.name = os.path.abspath(name)
+		self.points = points
+		self.frames = frames
+		self.images = None
+		self.index = None
+		self.timestamps = None
+		if mode == 'r':
+			self.images = np.load(self.name + ".cube.npy", mmap_mode='r')
+			self.index = np.load(self.name + ".index.npy", mmap_mode='r')
+			self.timestamps = np.load(self.name + ".timestamps.npy", mmap_mode='r')
+			self.points, self.frames = self.timestamps.shape
+
+	@staticmethod
+	def create(name, points, frames):
+		'''Start a new cube. The image array is allocated by the first append()'''
+		cube = SeriesCube(name, points, frames, mode='w')
+		cube.index = np.lib.format.open_memmap(cube.name + ".index.npy", mode='w+', dtype=INDEX_DTYPE, shape=(points,))
+		cube.timestamps = np.lib.format.open_memmap(cube.name + ".timestamps.npy", mode='w+', dtype=np.float64, shape=(points, frames))
+		cube.timestamps[:] = np.nan
+		return cube
+
+	@staticmethod
+	def load(name):
+		'''Open an existing cube read-only, images are only read when sliced'''
+		return SeriesCube(name, 0, 0, mode='r')
+
+	def __len__(self):
+		return self.points
+
+	def __getitem__(self, key):
+		return self.images[key]
+
+	def append(self, point, total, delay, exptime, mcp, frames, start, elapsed, timestamps,
+			   delivered=0, dropped=0, missed=0, intervalMax=0.0):
+		if self.images is None:
+			self.images = np.lib.format.open_memmap(self.name + ".cube.npy", mode='w+', dtype=total.dtype,
+													shape=(self.points,) + total.shape)
+		self.images[point] = total
+		self.images.flush()
+		count = min(len(timestamps), self.frames)
+		self.timestamps[point, :count] = timestamps[:count]
+		self.timestamps.flush()
+		self.index[point] = (delay, exptime, mcp, frames, start, elapsed, True, delivered, dropped, missed, intervalMax)
+		self.index.flush()
+
+	def close(self):
+		self.images = None
+		self.index = None
+		self.timestamps = None
+
+	def exportLegacy(self, prefix=None):
+		'''Write the written points as the per-point <prefix><delay>ps.mat/.txt files of older runs'''
+		if prefix is None:
+			prefix = self.name
+		for point in range(self.points):
+			row = self.index[point]
+			if not row['written']:
+				continue
+			filename = '%s%ips' % (prefix, int(round(row['delay'] * 1e12)))
+			total = np.asarray(self.images[point])
+			scaleFactor = 1
+			if (total.max() > 65536):
+				scaleFactor = total.max() / 65536
+			image = (total / scaleFactor).astype(np.uint16)
+			timestamps = np.asarray(self.timestamps[point])
+			scipy.io.savemat(filename + ".mat", mdict={'image': image, 'timestamps': timestamps[~np.isnan(timestamps)]})
+			textFile = open(filename + ".txt", "w")
+			try:
+				textFile.write("frames = %d\n" % row['frames'])
+				textFile.write("timeTaken = %0.2fs\n" % row['elapsed'])
+				textFile.write("width = %d\n" % total.shape[1])
+				textFile.write("height = %d\n" % total.shape[0])
+				textFile.write("scaleFactor = %0.3f\n" % (scaleFactor))
+				textFile.write("mcp = %f\n" % row['mcp'])
+				textFile.write("exptime = %e\n" % row['exptime'])
+				textFile.write("delay = %e\n" % row['delay'])
+			finally:
+				textFile.close()
@@ -0,0 +1,99 @@
+import os
+import re
+import numpy as np
+import scipy.io
+from acquisition import reduceImage
+
+class FlatFieldLibrary(object):
+	'''Flat fields per MCP voltage, kept as precomputed float32 reciprocal maps.
+
+	Flats are read from directory as flat_<mcp>V.npy, or flat_<mcp>V.mat with
+	the image in 'image' like the .mat files written by capture(). Each flat
+	is loaded once and normalised to a mean of one. For a voltage without its
+	own flat the normalised flats of the nearest voltages below and above are
+	interpolated linearly, outside the measured range the nearest flat is
+	used. Pixels darker than minimum times the mean are left uncorrected.
+	For cropped or binned images the flat is reduced the same way, averaging
+	each bin, before the reciprocal is taken.'''
+
+	PATTERN = re.compile(r'^flat_(\d+(?:\.\d+)?)V\.(npy|mat)$')
+
+	def __init__(self, directory, minimum=0.05):
+		self.directory = os.path.abspath(directory)
+		self.minimum = minimum
+		self.flats = {}
+		self.cache = {}
+		self.files = {}
+		self.refresh()
+
+	def refresh(self):
+		'''Rescan directory for flats and forget everything loaded so far'''
+		self.files = {}
+		if os.path.isdir(self.directory):
+			for name in os.listdir(self.directory):
+				match = self.PATTERN.match(name)
+				if match:
+					self.files[float(match.group(1))] = os.path.join(self.directory, name)
+		self.flats = {}
+		self.cache = {}
+		return self
+
+	def voltages(self):
+		return sorted(self.files.keys())
+
+	def flat(self, mcp):
+		'''The normalised flat measured at exactly this voltage'''
+		if mcp not in self.flats:
+			path = self.files[mcp]
+			if path.endswith(".npy"):
+				image = np.load(path)
+			else:
+				image = scipy.io.loadmat(path)['image']
+			image = image.astype(np.float32)
+			self.flats[mcp] = image / image.mean()
+		return self.flats[mcp]
+
+	def get(self, mcp, roi=None, binning=1):
+		'''Reciprocal map for an MCP voltage and image geometry, None when there are no flats'''
+		mcp = float(mcp)
+		key = (mcp, tuple(roi) if roi is not None else None, binning)
+		if key in self.cache:
+			return self.cache[key]
+		voltages = self.voltages()
+		if len(voltages) == 0:
+			return None
+		below = [v for v in voltages if v <= mcp]
+		above = [v for v in voltages if v >= mcp]
+		if len(below) == 0 or len(above) == 0:
+			flat = self.flat((below or above)[-1 if below else 0])
+		elif below[-1] == above[0]:
+			flat = self.flat(mcp)
+		else:
+			(low, high) = (below[-1], above[0])
+			weight = np.float32((mcp - low) / (high - low))
+			flat = (1 - weight) * self.flat(low) + weight * self.flat(high)
+		flat = reduceImage(flat, roi, binning, average=True)
+		reciprocal = np.ones(flat.shape, np.float32)
+		np.divide(1, flat, out=reciprocal, where=flat > self.minimum)
+		self.cache[key] = reciprocal
+		return reciprocal
+
+	def put(self, mcp, image):
+		'''Store a new flat for a voltage as flat_<mcp>V.npy'''
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		path = os.path.join(self.directory, "flat_%gV.npy" % mcp)
+		np.save(path, np.asarray(image))
+		self.refresh()
+		return path
+
+
+def applyFlatField(total, reciprocal):
+	'''Multiply an accumulated image by a reciprocal flat map, keeping its dtype'''
+	if reciprocal.shape != total.shape:
+		raise ValueError("Flat field is %s but the image is %s" % (reciprocal.shape, total.shape))
+	corrected = total * reciprocal
+	if np.issubdtype(total.dtype, np.integer):
+		np.rint(corrected, out=corrected)
+		np.clip(corrected, 0, np.iinfo(total.dtype).max, out=corrected)
+	return corrected.astype(total.dtype)
@@ -16,8 +16,21 @@
 # TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
+import time
+import threading
+import Queue
 import serial
 
+class BatchError(ValueError):
+    '''A command of a batch failed. command and index name it, replies holds
+    the answers read so far (all of them for an error answer)'''
+
+    def __init__(self,command,index,replies,message):
+        ValueError.__init__(self,'%r (command %i of the batch): %s' % (command,index+1,message))
+        self.command=command
+        self.index=index
+        self.replies=replies
+
 class Instrument:
     '''Abstract base class for a laboratory instrument'''
 
@@ -26,6 +39,8 @@ class Instrument:
         self.address=address
         self.instrtype=instrtype
         self.debug=False
+        # read past the end of the last answer, the start of the next ones
+        self.pending=''
 
         if self.instrtype is 'serial':
             self.handle=serial.Serial(self.address,timeout=10)
@@ -48,11 +63,70 @@ class Instrument:
         return res
 
     def readline(self):
-        res=self.handle.readline()
+        if '\n' in self.pending:
+            res,self.pending=self.pending.split('\n',1)
+            res+='\n'
+        else:
+            res=self.pending+self.handle.readline()
+            self.pending=''
+        if self.debug:
+            print(res)
+        return res
+
+    def readuntil(self,terminator,timeout=10):
+        '''Read up to and including the next terminator. The serial timeout only
+        sets how often the deadline is checked, timeout is the error bound'''
+        res=self.pending
+        deadline=time.time()+timeout
+        while terminator not in res:
+            if time.time() > deadline:
+                self.pending=res
+                raise ValueError,'No complete answer from instrument (got %r)!' % res
+            res+=self.handle.read(max(self.handle.inWaiting(),1))
+
+        end=res.index(terminator)+len(terminator)
+        res,self.pending=res[:end],res[end:]
+
         if self.debug:
             print(res)
         return res
 
+    def drain(self):
+        '''Discard everything until the port goes quiet for one serial timeout'''
+        self.pending=''
+        while self.handle.read(max(self.handle.inWaiting(),1)) != '':
+            pass
+
+    def replyerror(self,command,reply):
+        '''Error message for a complete answer to command, None if it is fine'''
+        return None
+
+    def batch(self,commands,terminator,timeout=10):
+        '''Write several commands in one transfer, then read their answers in
+        order, each ending with terminator. timeout bounds every answer.
+        Returns the answers, raises BatchError for the first failed command'''
+        self.write(''.join(commands))
+        replies=[]
+        error=None
+        for index,command in enumerate(commands):
+            try:
+                reply=self.readuntil(terminator,timeout)
+            except ValueError,e:
+                # late answers of this and the later commands would be taken
+                # for the answers of the next commands, drop them
+                self.drain()
+                raise BatchError(command,index,replies,str(e))
+            replies.append(reply)
+            message=self.replyerror(command,reply)
+            if message is not None and error is None:
+                error=(command,index,message)
+
+        # all answers are read before raising an error answer, so the next
+        # command starts in sync
+        if error is not None:
+            raise BatchError(error[0],error[1],replies,error[2])
+        return replies
+
     def close(self):
         self.handle.close()
 
@@ -68,3 +142,116 @@ class Instrument:
         
 
 
+class Request:
+    '''A call queued for a PortOwner. wait() for its result'''
+
+    def __init__(self,function,args,kwargs,timeout):
+        self.function=function
+        self.args=args
+        self.kwargs=kwargs
+        self.deadline=time.time()+timeout
+        self.started=False
+        self.cancelled=False
+        self.result=None
+        self.error=None
+        self.done=threading.Event()
+        self.lock=threading.Lock()
+
+    def cancel(self):
+        '''Drop the call if the owner has not started it yet. Returns True if dropped'''
+        self.lock.acquire()
+        try:
+            if not self.started:
+                self.cancelled=True
+                self.error=ValueError('%s was cancelled' % self.function.__name__)
+                self.done.set()
+            return self.cancelled
+        finally:
+            self.lock.release()
+
+    def start(self):
+        '''Called by the owner, False if the call was cancelled or is overdue'''
+        self.lock.acquire()
+        try:
+            if not self.cancelled and time.time() > self.deadline:
+                self.cancelled=True
+                self.error=ValueError('%s timed out in the queue' % self.function.__name__)
+                self.done.set()
+            self.started=not self.cancelled
+            return self.started
+        finally:
+            self.lock.release()
+
+    def wait(self):
+        '''Block until the call finished and return its result, raising its
+        error. Past the deadline the call is cancelled if it has not started'''
+        if not self.done.wait(max(self.deadline-time.time(),0)):
+            if self.cancel() or not self.done.wait(0):
+                raise ValueError('%s timed out' % self.function.__name__)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class PortOwner(threading.Thread):
+    '''The one thread that talks to a port. Calls from any thread are queued
+    and run in order, so commands and answers of different callers never
+    interleave'''
+
+    def __init__(self,name='port'):
+        threading.Thread.__init__(self,name='%s owner' % name)
+        self.daemon=True
+        self.queue=Queue.Queue()
+
+    def submit(self,function,args=(),kwargs={},timeout=30):
+        request=Request(function,args,kwargs,timeout)
+        self.queue.put(request)
+        return request
+
+    def run(self):
+        while True:
+            request=self.queue.get()
+            if request is None:
+                break
+            if not request.start():
+                continue
+            try:
+                request.result=request.function(*request.args,**request.kwargs)
+            except Exception,e:
+                request.error=e
+            request.done.set()
+
+    def close(self):
+        '''Finish the queued calls and stop the thread'''
+        self.queue.put(None)
+        self.join()
+
+class Shared:
+    '''Thread safe facade for an instrument. Method calls block as before but
+    run on the instrument's PortOwner thread; submit() queues a call without
+    waiting and returns its Request'''
+
+    def __init__(self,instr,timeout=30):
+        self.__dict__['instrument']=instr
+        self.__dict__['timeout']=timeout
+        self.__dict__['owner']=PortOwner(instr.name)
+        self.owner.start()
+
+    def submit(self,name,*args,**kwargs):
+        timeout=kwargs.pop('timeout',self.timeout)
+        return self.owner.submit(getattr(self.instrument,name),args,kwargs,timeout)
+
+    def __getattr__(self,name):
+        attr=getattr(self.instrument,name)
+        if not callable(attr):
+            return attr
+        return lambda *args,**kwargs: self.submit(name,*args,**kwargs).wait()
+
+    def __setattr__(self,name,value):
+        setattr(self.instrument,name,value)
+
+    def __str__(self):
+        return self.submit('__str__').wait()
+
+    def close(self):
+        self.owner.close()
+        self.instrument.close()
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+import traceback
+import numpy as np
+import scipy.io
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+# name: (file extension, description)
+ENCODINGS = {'scaled': ('.mat', 'uint16 MATLAB file, scaled down when the sum exceeds 65536 (lossy)'),
+			 'uint32': ('.mat', 'uint32 MATLAB file with the native sums'),
+			 'mat-zlib': ('.mat', 'uint32 MATLAB file, zlib compressed'),
+			 'npz': ('.npz', 'uint32 NumPy archive, zlib compressed')}
+
+def encodeImage(filename, total, timestamps, encoding='scaled', extra=None):
+	'''Write an accumulated image in one of the ENCODINGS. Returns the scale factor applied.
+	extra holds further named arrays to store in the same file'''
+	if encoding not in ENCODINGS:
+		raise ValueError("Unknown output encoding %s" % encoding)
+	scaleFactor = 1
+	image = total
+	if encoding == 'scaled':
+		#image = (65536 * (image - image.min())/(image.max()-image.min())).astype(np.uint16)
+		if (total.max() > 65536):
+			scaleFactor = total.max() / 65536
+		image = (total / scaleFactor).astype(np.uint16)
+	elif total.dtype != np.uint32:
+		image = total.astype(np.uint32)
+	mdict = {'image': image, 'timestamps': timestamps}
+	mdict.update(extra or {})
+	if encoding == 'npz':
+		np.savez_compressed(filename + ".npz", **mdict)
+	else:
+		scipy.io.savemat(filename + ".mat", mdict=mdict, do_compression=(encoding == 'mat-zlib'))
+	return scaleFactor
+
+def benchmarkEncodings(total, directory='.', repeats=3):
+	'''Time every encoding on an image. Returns {encoding: (bytes, seconds per write)}'''
+	results = {}
+	timestamps = np.arange(100, dtype=np.float64) * 0.04
+	for encoding in sorted(ENCODINGS):
+		filename = os.path.join(directory, "benchmark_%s" % encoding)
+		start = time.time()
+		for n in range(repeats):
+			encodeImage(filename, total, timestamps, encoding)
+		elapsed = (time.time() - start) / repeats
+		path = filename + ENCODINGS[encoding][0]
+		results[encoding] = (os.path.getsize(path), elapsed)
+		os.remove(path)
+	return results
+
+
+class OutputWriter(object):
+	'''Writes finished acquisitions on a background thread.
+
+	put() hands a complete output record to the writer and returns at once
+	unless the bounded queue is full, in which case it blocks until the disk
+	catches up. flush() waits for every pending record to be written.'''
+
+	def __init__(self, write, maxPending=4):
+		self.write = write
+		self.queue = queue.Queue(maxPending)
+		self.errors = []
+		self.thread = threading.Thread(None, self.run, name="OutputWriter")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, record):
+		self.queue.put(record)
+
+	def pending(self):
+		return self.queue.qsize()
+
+	def flush(self):
+		'''Wait for all pending records. Returns False if any of them failed to write'''
+		self.queue.join()
+		ok = len(self.errors) == 0
+		self.errors = []
+		return ok
+
+	def join(self):
+		'''Wait for all pending records, keeping their errors for flush()'''
+		self.queue.join()
+
+	def close(self):
+		ok = self.flush()
+		self.queue.put(None)
+		self.thread.join()
+		return ok
+
+	def run(self):
+		while True:
+			record = self.queue.get()
+			try:
+				if record is None:
+					return
+				self.write(record)
+			except Exception as e:
+				print("Writing %s failed" % record.get('filename'))
+				traceback.print_exc()
+				self.errors.append(e)
+			finally:
+				self.queue.task_done()
+
+
+class RawFrameRecorder(object):
+	'''Streams raw frames into a preallocated memory-mapped .npy stack.
+
+	<name>.npy is a (frames x height x width) array and <name>.index.npy
+	holds the sequence number and arrival time of every frame, -1 and NaN
+	for slots not yet written. Frames are copied into the page cache
+	sequentially and the OS writes them back in large blocks, so recording
+	never waits on the disk and an aborted run leaves a readable file.'''
+
+	INDEX_DTYPE = [('frame', np.int64), ('timestamp', np.float64)]
+
+	def __init__(self, name, frames, shape, dtype):
+		self.name = os.path.abspath(name)
+		self.stack = np.lib.format.open_memmap(self.name + ".npy", mode='w+', dtype=dtype, shape=(frames,) + tuple(shape))
+		self.index = np.lib.format.open_memmap(self.name + ".index.npy", mode='w+', dtype=self.INDEX_DTYPE, shape=(frames,))
+		self.index['frame'] = -1
+		self.index['timestamp'] = np.nan
+		self.count = 0
+
+	def record(self, frame, timestamp=None):
+		if self.count >= len(self.stack):
+			return False
+		self.stack[self.count] = frame
+		self.index[self.count] = (self.count, time.time() if timestamp is None else timestamp)
+		self.count += 1
+		return True
+
+	def close(self):
+		if self.stack is not None:
+			self.stack.flush()
+			self.index.flush()
+		self.stack = None
+		self.index = None
+
+	@staticmethod
+	def load(name):
+		'''Return the recorded frames and their index, memory-mapped read-only'''
+		index = np.load(name + ".index.npy")
+		count = int((index['frame'] >= 0).sum())
+		return np.load(name + ".npy", mmap_mode='r')[:count], index[:count]
+
+
+if __name__ == '__main__':
+	# sparse low light image: 100 summed frames of mostly dark counts with a few bright spots
+	total = np.random.poisson(0.05, (470, 630)).astype(np.uint32) * 100
+	total[200:260, 300:360] += np.random.poisson(2000, (60, 60)).astype(np.uint32)
+	for (encoding, (size, elapsed)) in sorted(benchmarkEncodings(total).items()):
+		print('%-10s %10d bytes %8.2f ms  %s' % (encoding, size, elapsed * 1000, ENCODINGS[encoding][1]))
@@ -16,8 +16,40 @@
 # TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
 # PERFORMANCE OF THIS SOFTWARE.
 
+import time
 import instrument
 
+class PicosStatus:
+    '''Parsed status dump of a Picos 4 ('s' command)'''
+
+    def __init__(self,lines=[]):
+        self.gain='unknown'
+        self.exptime='unknown'
+        self.delay='unknown'
+        self.trigger='unknown'
+        self.videoGain='unknown'
+        self.taken=time.time()
+        for line in lines:
+            self.parse(line)
+
+    def parse(self,res):
+        if res[0:5] == 'Gain=':
+            self.gain=int(float(res[5:].rstrip('V\r\n')))
+        elif res[0:7] == 'Time = ':
+            self.exptime=float(res[7:res.find('s')])
+            # XXX ugly hack
+            self.delay=float(res[res.find('y')+3:res.find('s',20)])
+        elif res == 'Fsync out  connected to -Trig in\r\n':
+            self.trigger='FSync'
+        elif res == 'externally triggered, use -Trig/+Trig\r\n':
+            self.trigger='external'
+        elif res[0:13] == 'Video Gain = ':
+            # XXX ugly hack
+            self.videoGain=int(res[13:15])
+
+    def age(self):
+        return time.time()-self.taken
+
 class StanfordPicos4(instrument.Instrument):
     '''Stanford Research Picos 4 ICCD'''
 
@@ -33,6 +65,17 @@ class StanfordPicos4(instrument.Instrument):
         self.handle.setStopbits(1)
         self.handle.setTimeout(0.1)
 
+        # getters are served from the last status dump for this long (in s)
+        self.statusTTL=1.0
+        self.snapshot=None
+
+        # answers end with the prompt, this is only how long to wait for it
+        self.prompt=None
+        self.replyTimeout=2.0
+
+        # last confirmed device settings, writes of an unchanged value are skipped
+        self.shadow={}
+
         # set to gamma = 1
         self.write('y1\r\n')
 
@@ -40,132 +83,201 @@ class StanfordPicos4(instrument.Instrument):
         self.write('f0\r\n')
 
         self.__cleanbuffer()
+        self.__learnprompt()
+        self.refreshShadow()
 
     def __cleanbuffer(self):
         res=self.readline() 
+        lines=[]
         while res != '':
+            lines.append(res)
             res=self.readline()
+        return lines
+
+    def __learnprompt(self):
+        '''An empty command is answered by the prompt alone, remember it so
+        that answers can be framed by it instead of waiting for silence'''
+        self.write('\r\n')
+        res=''.join(self.__cleanbuffer())
+        # the prompt is the unterminated last line, including any trailing blank
+        prompt=res[res.rfind('\n')+1:]
+        self.prompt=prompt if prompt.strip() != '' else None
+
+    def __reply(self):
+        '''Read the answer to the last command, as a list of lines'''
+        if self.prompt is None:
+            return self.__cleanbuffer()
+        res=self.readuntil(self.prompt,self.replyTimeout)
+        return res[:-len(self.prompt)].splitlines(True)
 
     def __str__(self):
-        str = "Stanford Picos 4 ICCD (texp = %e s, " % self.GetExposureTime()\
-            + "tdel = %e s, " % self.GetExposureDelay()\
-            + "MCP %i V, " % self.GetGain()\
-            + "trigger is %s)" % self.GetTriggerSource()
+        status=self.status()
+        str = "Stanford Picos 4 ICCD (texp = %e s, " % status.exptime\
+            + "tdel = %e s, " % status.delay\
+            + "MCP %i V, " % status.gain\
+            + "trigger is %s)" % status.trigger
 
         return str
 
+    def status(self,maxAge=None):
+        '''Read and parse the full status dump, or return the last one if
+        it is younger than maxAge (statusTTL by default)'''
+        if maxAge is None:
+            maxAge=self.statusTTL
+        if self.snapshot is not None and self.snapshot.age() < maxAge:
+            return self.snapshot
+
+        self.write('s\r\n')
+        self.snapshot=PicosStatus(self.__reply())
+        return self.snapshot
+
+    def invalidate(self):
+        '''Forget the status snapshot, the next getter reads the device again'''
+        self.snapshot=None
+
+    def refreshShadow(self):
+        '''Read the device settings into the shadow registers'''
+        status=self.status(maxAge=0)
+        self.shadow={}
+        if status.exptime != 'unknown':
+            self.shadow['exptime']=float('%e' % status.exptime)
+        if status.delay != 'unknown':
+            self.shadow['delay']=float('%e' % status.delay)
+        if status.gain != 'unknown':
+            self.shadow['gain']=status.gain
+        if status.trigger != 'unknown':
+            self.shadow['trigger']={'FSync':'Fsync'}.get(status.trigger,status.trigger)
+        if status.videoGain != 'unknown':
+            self.shadow['videoGain']=status.videoGain
+        return self.shadow
+
+    def replyerror(self,command,reply):
+        for line in reply.splitlines():
+            if 'error' in line.lower():
+                return line.strip()
+        return None
+
+    def __apply(self,settings):
+        '''Send the (key, value, commands) settings that differ from the
+        shadow, all in one batch when the prompt is known. Returns the keys sent'''
+        settings=[(key,value,commands) for (key,value,commands) in settings
+                  if self.shadow.get(key) != value]
+        if len(settings) == 0:
+            return []
+        self.invalidate()
+        # unknown until the device has answered
+        for (key,value,commands) in settings:
+            self.shadow.pop(key,None)
+
+        if self.prompt is None:
+            for (key,value,commands) in settings:
+                for command in commands:
+                    self.write(command)
+                    self.__reply()
+                self.shadow[key]=value
+            return [key for (key,value,commands) in settings]
+
+        try:
+            self.batch(sum([commands for (key,value,commands) in settings],[]),
+                       self.prompt,self.replyTimeout)
+        except instrument.BatchError,e:
+            # settings answered before the failing command are confirmed
+            done=0
+            for (key,value,commands) in settings:
+                done+=len(commands)
+                if done > e.index:
+                    break
+                self.shadow[key]=value
+            raise
+        for (key,value,commands) in settings:
+            self.shadow[key]=value
+        return [key for (key,value,commands) in settings]
+
+    def configure(self,exptime=None,delay=None,gain=None,trigger=None,videoGain=None):
+        '''Bring the device to the given settings (None leaves a setting alone),
+        sending only those that differ from the shadow in one batch. Returns the names sent'''
+        settings=[]
+        if exptime is not None:
+            settings.append(('exptime',float('%e' % exptime),['t%e\r\n' % exptime]))
+        if delay is not None:
+            settings.append(('delay',float('%e' % delay),['d%e\r\n' % delay]))
+        if gain is not None:
+            if gain < 0 or gain > 1000:
+                raise ValueError,'MCP gain must be between 0 and 1000V!'
+            settings.append(('gain',int(gain),['g%i\r\n' % int(gain)]))
+        if trigger is not None:
+            if trigger not in ('Fsync','external'):
+                raise ValueError,'Trigger source must be either Fsync or external!'
+            settings.append(('trigger',trigger,[{'Fsync':'cf\r\n','external':'c-\r\n'}[trigger]]))
+        if videoGain is not None:
+            if videoGain < 0 or videoGain > 25:
+                raise ValueError,'Video Gain has to be between 0 and 25 dB!'
+            # manual gain is its own register, the status dump does not show it so
+            # it is sent once after start-up and every reset
+            settings.append(('autoGain',False,['a0\r\n']))
+            settings.append(('videoGain',int(videoGain),['v%i\r\n' % videoGain]))
+        return self.__apply(settings)
+
+    def reconnect(self):
+        '''Reopen the serial port and read the device state again'''
+        self.invalidate()
+        self.handle.close()
+        self.pending=''
+        self.handle.open()
+        self.__cleanbuffer()
+        self.__learnprompt()
+        self.refreshShadow()
+
     def reset(self):
+        self.invalidate()
+        self.shadow={}
         self.write('i\r\n')
-        self.__cleanbuffer()
+        if self.prompt is None:
+            self.__cleanbuffer()
+        else:
+            # the reset takes longer than any other command
+            self.readuntil(self.prompt,10*self.replyTimeout)
+        self.refreshShadow()
 
     def SetGain(self,gain):
         '''Set MCP gain (in V)'''
-        if gain >= 0 and gain <=1000:
-            self.write('g%i\r\n' % int(gain))
-            self.__cleanbuffer()
-        else:
-            raise ValueError,'MCP gain must be between 0 and 1000V!'
+        return len(self.configure(gain=gain)) > 0
 
     def GetGain(self):
         '''Get MCP gain in V'''
-        self.write('s\r\n')
-        res='x'
-        gain='unknown'
-        while res is not '':
-            res=self.readline()
-            if res[0:5] == 'Gain=':
-                gain=int(float(res[5:].rstrip('V\r\n')))
-
-        self.__cleanbuffer()
-        return gain
+        return self.status().gain
 
     def SetExposureTime(self,exptime):
         '''Set exposure time in s'''
-        self.write('t%e\r\n' % exptime)
-        self.__cleanbuffer()
+        return len(self.configure(exptime=exptime)) > 0
 
     def GetExposureTime(self):
         '''Get exposure time in s'''
-        self.write('s\r\n')
-        res='x'
-        exptime='unknown'
-        while res is not '':
-            res=self.readline()
-            if res[0:7] == 'Time = ':
-                exptime=float(res[7:res.find('s')])
-
-        self.__cleanbuffer()
-        return exptime
+        return self.status().exptime
 
     def SetExposureDelay(self,delay):
         '''Set delay after trigger in s'''
-        self.write('d%e\r\n' % delay)
-        self.__cleanbuffer()
+        return len(self.configure(delay=delay)) > 0
 
     def GetExposureDelay(self):
         '''Get delay after trigger in s'''
-        self.write('s\r\n')
-        res='x'
-        delay='unknown'
-        while res is not '':
-            res=self.readline()
-            if res[0:7] == 'Time = ':
-                # XXX ugly hack
-                delay=float(res[res.find('y')+3:res.find('s',20)])
-
-        self.__cleanbuffer()
-        return delay
+        return self.status().delay
 
     def SetTriggerSource(self,trigger='Fsync'):
         '''Set trigger source (either 'FSync' or 'external')''' 
-        if trigger == 'Fsync':
-            self.write('cf\r\n')
-        elif trigger == 'external':
-            self.write('c-\r\n')
-        else:
-            raise ValueError,'Trigger source must be either Fsync or external!'
-
-        self.__cleanbuffer()
+        return len(self.configure(trigger=trigger)) > 0
 
     def GetTriggerSource(self):
         '''Get trigger source (either 'FSync' or "external')'''
-        self.write('s\r\n')
-        res='x'
-        trigger='unknown'
-        while res is not '':
-            res=self.readline()
-            if res == 'Fsync out  connected to -Trig in\r\n':
-                return 'FSync'
-            elif res == 'externally triggered, use -Trig/+Trig\r\n':
-                return 'external'
-
-        self.__cleanbuffer()
-        return trigger
+        return self.status().trigger
 
     def SetVideoGain(self,gain):
         '''Set CCD video gain in db (0 <= gain <= 20)'''
-
-        if gain < 0 or gain > 25:
-            raise ValueError,'Video Gain has to be between 0 and 25 dB!'
-
-        self.write('a0\r\n')
-        self.__cleanbuffer()        
-        self.write('v%i\r\n' % gain)
-        self.__cleanbuffer()
+        return len(self.configure(videoGain=gain)) > 0
 
     def GetVideoGain(self):
         '''Get CCD video gain in db'''
-        self.write('s\r\n')
-        res='x'
-        vgain='unknown'
-        while res is not '':
-            res=self.readline()
-            if res[0:13] == 'Video Gain = ':
-                # XXX ugly hack
-                vgain=int(res[13:15])
-
-        self.__cleanbuffer()
-        return vgain
+        return self.status().videoGain
 
 if __name__ == '__main__':
     c=StanfordPicos4()